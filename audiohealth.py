@@ -2,98 +2,1146 @@
 # (c) 2017 Richard Pobering <richard@hiveeyes.org>
 # (c) 2017-2021 Andreas Motl <andreas@hiveeyes.org>
 import os
+import io
 import sys
+import glob
+import json
 import shlex
+import hashlib
+import functools
+import struct
 import shutil
+import mmap
+import resource
+import threading
 import subprocess
+import time
 from docopt import docopt
-from tempfile import NamedTemporaryFile
+from contextlib import contextmanager, redirect_stdout, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from tempfile import NamedTemporaryFile, TemporaryFile, mkdtemp
 from operator import itemgetter
+from datetime import datetime, timezone
+from collections import Counter
+from signal import SIGINT, SIGTERM
 from colors import color
 from scipy import signal
 import scipy.io.wavfile as wav
 import numpy as np
 import aubio
-try:
-    import matplotlib.pyplot as plt
-    import matplotlib.colors as colors
-except:
-    sys.stderr.write('WARNING: matplotlib not available. Will not be able to generate images.\n')
 
 
 VERSION  = '0.5.0'
 APP_NAME = 'audiohealth ' + VERSION
 
-def resample(audiofile):
-    tmpfile = NamedTemporaryFile(suffix='.wav', delete=False)
+# Signal preparation chain, see "resample()" and "resample_native()".
+SAMPLERATE  = 6300
+BANDPASS    = (30, 3150)
+NORM_DB     = -3
+RESAMPLERS  = ['sox', 'native']
+SIGNAL_CHAIN = 'norm {norm} sinc {low}-{high} rate {rate}'.format(
+    norm=NORM_DB, low=BANDPASS[0], high=BANDPASS[1], rate=SAMPLERATE)
+
+# Number of samples filtered at once by the native resampler, see "resample_blocks()".
+RESAMPLE_BLOCKSIZE = 2 ** 18
+
+# Classification strategies of osbh-audioanalyzer.
+STRATEGIES = ['dt-0.9', 'dt-1.0', 'dt-2.0', 'lr-2.0', 'lr-2.1']
+DEFAULT_STRATEGY = 'lr-2.1'
+
+# Suffix of checkpoint files for resuming the analysis of growing recordings.
+CHECKPOINT_SUFFIX = '.checkpoint.npz'
+
+# How samples are handed over to osbh-audioanalyzer, see "analyze()".
+TRANSPORTS  = ['text', 'binary']
+DAT_SUFFIX  = {'text': '.dat', 'binary': '.f32'}
+
+# The audio is chunked into segments of 10 seconds each, see:
+#   - tools/osbh-audioanalyzer/params.h: float windowLength=2; //Window Length in s
+#   - tools/osbh-audioanalyzer/main.cpp: DetectedStates.size()==5
+WINDOW_LENGTH = 2 * 5
+
+# Power spectrum analysis, see "analyze_peaks()".
+BAND250 = (220, 275)
+BAND500 = (445, 525)
+ACTIVITY_THRESHOLD = 1000
+QUEENLESS_RATIO = 0.6
+
+# Segment length of the Welch power spectra, see "welch()". Consecutive
+# segments overlap by half of it.
+WELCH_NPERSEG = 1024
+
+# Number of samples converted at once, see "pcm_blocks()".
+PCM_BLOCKSIZE = 2 ** 18
+
+# Output formats of reports.
+FORMATS = ['text', 'json', 'ndjson']
+
+# Time buckets for summarizing long sequences of states, in seconds.
+BUCKETS = {'hour': 3600, 'day': 86400}
+
+# Where to store cached results and how much space they might occupy.
+CACHE_DIR  = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'audiohealth')
+CACHE_SIZE = 2048 * 1024 ** 2
+# How many entries to add before rescanning the cache, see "ResultCache.put()".
+CACHE_SCAN_INTERVAL = 64
+
+# Which files to pick up when scanning directories in batch mode.
+AUDIO_EXTENSIONS = ['.wav', '.flac', '.ogg', '.mp3', '.m4a', '.aiff', '.au']
+
+# Spectral embeddings for similarity search, see "spectral_embeddings()": The
+# energy share of logarithmically spaced bands plus five peak features, per
+# window of EMBEDDING_WINDOW seconds.
+EMBEDDING_BANDS = np.geomspace(BANDPASS[0], BANDPASS[1], 13)
+EMBEDDING_SIZE = len(EMBEDDING_BANDS) - 1 + 5
+EMBEDDING_WINDOW = 60
+
+# Row layouts of the tables of an "Archive".
+ARCHIVE_TABLES = {
+    'recordings': np.dtype([
+        ('recording', '<u4'), ('hive', '<u2'), ('time', '<f8'), ('duration', '<f4'), ('windows', '<u4'),
+        ('band250', '<f4'), ('band500', '<f4'), ('ratio', '<f4')]),
+    'windows': np.dtype([('recording', '<u4'), ('hive', '<u2'), ('time', '<f8'), ('state', 'u1')]),
+    'peaks': np.dtype([('recording', '<u4'), ('freq', '<f4'), ('power', '<f4')]),
+    'embeddings': np.dtype([
+        ('recording', '<u4'), ('hive', '<u2'), ('time', '<f8'), ('vector', '<f4', (EMBEDDING_SIZE,))]),
+    'window_embeddings': np.dtype([
+        ('recording', '<u4'), ('hive', '<u2'), ('time', '<f8'), ('vector', '<f4', (EMBEDDING_SIZE,))]),
+}
+
+# Prefix of metric names exported to Prometheus, see "PrometheusExporter".
+METRICS_PREFIX = 'audiohealth'
+
+
+class AudiohealthError(Exception):
+    """
+    Raised when a processing step fails. The command line
+    interface reports the message and exits with "returncode".
+    """
+
+    def __init__(self, message, returncode=2):
+        super(AudiohealthError, self).__init__(message)
+        self.returncode = returncode
+
+
+class Profiler(object):
+    """
+    Record wall time, CPU time, peak RSS and bytes read and written for
+    each stage of the pipeline and each subprocess. Disabled by default,
+    see "--profile". Each completed record is also handed to all hooks,
+    like the "PrometheusExporter".
+
+    CPU time of stages is measured for the calling thread. Bytes read and
+    written are taken from /proc/self/io, so they include I/O of other
+    threads running concurrently, and are None where it is not available.
+    Peak RSS is the high-water mark of the whole process.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.hooks = []
+        self.records = []
+        self.lock = threading.Lock()
+
+    def enable(self, hooks=None):
+        self.enabled = True
+        self.hooks = list(hooks or [])
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def reset(self):
+        """
+        Return the records collected so far and start over.
+        """
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        before = io_counters()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            after = io_counters()
+            self.add({
+                'stage': name,
+                'type': 'stage',
+                'wall': time.perf_counter() - wall,
+                'cpu': time.thread_time() - cpu,
+                'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'bytes_read': after and after['rchar'] - before['rchar'],
+                'bytes_written': after and after['wchar'] - before['wchar'],
+            })
+
+PROFILER = Profiler()
+
+def profiled(name):
+    """
+    Decorator recording each call of a function as stage "name".
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def io_counters():
+    """
+    Read the I/O counters of the current process, including those of reaped children.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return dict((key, int(value)) for key, value in (line.split(':') for line in f))
+    except (OSError, ValueError):
+        return None
 
-    # Number of channels?
+def run_command(name, cmd, stdin=None, capture=True, input=None):
+    """
+    Run a command to completion, returning its exit code and standard output.
+    When given, "input" is fed to its standard input, from memory.
+    When profiling, the resources used by the command are recorded as well.
+    """
+    stdout = subprocess.PIPE if capture else None
+    if input is not None:
+        stdin = subprocess.PIPE
+    if not (PROFILER.enabled and hasattr(os, 'wait4')):
+        process = subprocess.Popen(cmd, stdin=stdin, stdout=stdout)
+        output, _ = process.communicate(input)
+        return process.returncode, output
+
+    before = io_counters()
+    wall = time.perf_counter()
+    process = subprocess.Popen(cmd, stdin=stdin, stdout=stdout)
+
+    # Feed the input from another thread, so the command can't
+    # block on writing its output while waiting for more input.
+    feeder = None
+    if input is not None:
+        def feed():
+            try:
+                process.stdin.write(input)
+            except BrokenPipeError:
+                pass
+            finally:
+                process.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+    output = None
+    if capture:
+        output = process.stdout.read()
+        process.stdout.close()
+    if feeder:
+        feeder.join()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    after = io_counters()
+
+    # Reading the output of the command and writing its input counts for this process, not for the command.
+    received = len(output) if output else 0
+    sent = memoryview(input).nbytes if input is not None else 0
+    PROFILER.add({
+        'stage': name,
+        'type': 'subprocess',
+        'wall': time.perf_counter() - wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'peak_rss': usage.ru_maxrss * 1024,
+        'bytes_read': after and after['rchar'] - before['rchar'] - received,
+        'bytes_written': after and after['wchar'] - before['wchar'] - sent,
+    })
+    return process.returncode, output
+
+async def run_command_async(name, cmd, input=None, timeout=None):
+    """
+    Like "run_command()", but as coroutine, so many commands can run within
+    one event loop. Returns the exit code, standard output and standard error.
+    The command gets killed when it exceeds the timeout in seconds or when
+    the calling task is cancelled.
+    """
+    import asyncio
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(input), timeout)
+    except asyncio.TimeoutError:
+        raise AudiohealthError('{} did not finish within {}s. The command was:\n{}'.format(
+            name, timeout, ' '.join(cmd)))
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    return process.returncode, stdout, stderr
+
+class PrometheusExporter(object):
+    """
+    Profiler hook maintaining totals for each stage and subprocess in
+    a file, using the textfile format of the Prometheus node exporter.
+    The file is replaced atomically on each update.
+    """
+
+    METRICS = [
+        ('runs_total', 'counter', 'Number of completed runs'),
+        ('wall_seconds_total', 'counter', 'Wall time spent'),
+        ('cpu_seconds_total', 'counter', 'CPU time spent'),
+        ('read_bytes_total', 'counter', 'Bytes read'),
+        ('written_bytes_total', 'counter', 'Bytes written'),
+        ('peak_rss_bytes', 'gauge', 'Highest peak resident set size'),
+    ]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            totals = self.totals.setdefault((record['type'], record['stage']), dict.fromkeys(
+                [name for name, _, _ in self.METRICS], 0))
+            totals['runs_total'] += 1
+            totals['wall_seconds_total'] += record['wall']
+            totals['cpu_seconds_total'] += record['cpu']
+            totals['read_bytes_total'] += record['bytes_read'] or 0
+            totals['written_bytes_total'] += record['bytes_written'] or 0
+            totals['peak_rss_bytes'] = max(totals['peak_rss_bytes'], record['peak_rss'])
+            self.write()
+
+    def write(self):
+        lines = []
+        for name, kind, description in self.METRICS:
+            metric = '{}_{}'.format(METRICS_PREFIX, name)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for (type, stage), totals in sorted(self.totals.items()):
+                lines.append('{}{{type="{}",stage="{}"}} {}'.format(metric, type, stage, totals[name]))
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmpfile, self.filename)
+
+def print_profile(records, stream=None):
+    """
+    Render profile records as a table.
+    """
+    stream = stream or sys.stdout
+    mib = lambda value: '{:10.1f}'.format(value / 2.0 ** 20) if value is not None else '{:>10}'.format('-')
+    stream.write('=======\nProfile\n=======\n')
+    stream.write('{:24} {:10} {:>9} {:>9} {:>10} {:>10} {:>10}\n'.format(
+        'stage', 'type', 'wall [s]', 'cpu [s]', 'rss [MiB]', 'read [MiB]', 'write [MiB]'))
+    for record in records:
+        stream.write('{:24} {:10} {:9.3f} {:9.3f} {} {} {}\n'.format(
+            record['stage'], record['type'], record['wall'], record['cpu'],
+            mib(record['peak_rss']), mib(record['bytes_read']), mib(record['bytes_written'])))
+    stream.write('\n')
+
+def sox_channels(audiofile):
+    """
+    Determine the number of channels of audiofile using soxi.
+    """
+    cmd = ['soxi', '-c', audiofile]
     try:
-        cmd = ['soxi', '-c', audiofile]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        stdout, stderr = process.communicate()
+        returncode, stdout = run_command('soxi', cmd)
     except:
-        print("ERROR: Could not determine number of audio channels. Did you install sox?")
-        print("The command was:")
-        print(' '.join(cmd))
-        sys.exit(2)
-
-    remix_option = ''
-    if process.returncode == 0:
-        if stdout.strip() == '2':
-            remix_option = 'remix 1,2'
-    else:
-        print('ERROR: Could not determine number of audio channels. The program "soxi" failed.')
-        print("The command was:")
-        print(cmd)
-        sys.exit(2)
+        raise AudiohealthError('Could not determine number of audio channels. Did you install sox?\n'
+                               'The command was:\n{}'.format(' '.join(cmd)))
+    if returncode != 0:
+        raise AudiohealthError('Could not determine number of audio channels. The program "soxi" failed.\n'
+                               'The command was:\n{}'.format(cmd))
+    return int(stdout.decode('utf-8').strip())
+
+def sox_command(audiofile, output, channels=None):
+    """
+    Build the sox command for downsampling audiofile, writing to output.
+    Unless given, the number of channels is determined using soxi.
+    """
+    if channels is None:
+        channels = sox_channels(audiofile)
+    remix_option = 'remix 1,2' if channels == 2 else ''
 
     # Normalize, apply bandpass filter and resample
-    command = 'sox "{input}" "{output}" {remix_option} norm -3 sinc 30-3150 rate 6300'.format(input=audiofile, output=tmpfile.name, remix_option=remix_option)
+    return 'sox "{input}" {output} {remix_option} {chain}'.format(
+        input=audiofile, output=output, remix_option=remix_option, chain=SIGNAL_CHAIN)
+
+@profiled('resample')
+def resample(audiofile):
+    tmpfile = NamedTemporaryFile(suffix='.wav', delete=False)
+    command = sox_command(audiofile, '"{}"'.format(tmpfile.name))
+    cmd = shlex.split(command)
+    try:
+        status, _ = run_command('sox', cmd, capture=False)
+    except:
+        status = None
+    if status == 0:
+        return tmpfile.name
+    raise AudiohealthError('Error while downsampling. Did you install sox?\n'
+                           'The command was:\n{}'.format(command))
+
+@profiled('resample')
+def resample_samples(audiofile):
+    """
+    Like "resample()", but sox writes raw 16-bit samples to a pipe
+    instead of an intermediate .wav file on disk.
+
+    Returns the target samplerate and a float32 array with values ranging
+    from -1 to 1, identical to what "wav_to_dat()" reads from the .wav file.
+    """
+    command = sox_command(audiofile, '-t raw -e signed-integer -b 16 -L -')
     cmd = shlex.split(command)
     try:
-        status = subprocess.check_call(cmd)
-        if status == 0:
-            return tmpfile.name
+        status, output = run_command('sox', cmd)
     except:
-        print("Error while downsampling. Did you install sox?")
-        print("The command was:")
-        print(command)
-        sys.exit(2)
+        status = None
+    if status == 0:
+        samples = np.frombuffer(output, dtype='<i2')
+        return SAMPLERATE, (samples / np.float32(2 ** 15)).astype(np.float32)
+    raise AudiohealthError('Error while downsampling. Did you install sox?\n'
+                           'The command was:\n{}'.format(command))
+
+async def resample_async(audiofile, timeout=None):
+    """
+    Like "resample_samples()", but as coroutine running soxi and sox
+    as async subprocesses. Their error output is part of any error.
+    """
+    cmd = ['soxi', '-c', audiofile]
+    try:
+        returncode, stdout, stderr = await run_command_async('soxi', cmd, timeout=timeout)
+    except OSError:
+        raise AudiohealthError('Could not determine number of audio channels. Did you install sox?\n'
+                               'The command was:\n{}'.format(' '.join(cmd)))
+    if returncode != 0:
+        raise AudiohealthError('Could not determine number of audio channels. The program "soxi" failed.\n'
+                               'The command was:\n{}\n{}'.format(' '.join(cmd), stderr.decode('utf-8', 'replace').strip()))
+
+    command = sox_command(audiofile, '-t raw -e signed-integer -b 16 -L -', channels=int(stdout.decode('utf-8').strip()))
+    try:
+        returncode, output, stderr = await run_command_async('sox', shlex.split(command), timeout=timeout)
+    except OSError:
+        raise AudiohealthError('Error while downsampling. Did you install sox?\n'
+                               'The command was:\n{}'.format(command))
+    if returncode != 0:
+        raise AudiohealthError('Error while downsampling. The command was:\n{}\n{}'.format(
+            command, stderr.decode('utf-8', 'replace').strip()))
+    samples = np.frombuffer(output, dtype='<i2')
+    return SAMPLERATE, (samples / np.float32(2 ** 15)).astype(np.float32)
+
+class AudioDecoder(object):
+    """
+    Lazy decoder shared by all consumers of audio files, based on aubio,
+    which reads compressed formats like FLAC, OGG and MP3 directly through
+    libav or libsndfile, whichever it was built with.
+
+    Iterating yields float32 blocks of shape (frames, channels) with values
+    ranging from -1 to 1, so the whole recording is never held in memory
+    and no intermediate files are written. Blocks are only valid until
+    the next one is read.
+
+    Hop sizes below 4096 are raised to 4096, as multichannel reads of the
+    .wav reader of aubio return the same block over and over again with
+    small hop sizes. So, blocks may be bigger than requested, see "hop_size".
+    """
+
+    def __init__(self, audiofile, samplerate=0, hop_size=4096):
+        try:
+            self.source = aubio.source(audiofile, samplerate, max(hop_size, 4096))
+        except RuntimeError as ex:
+            raise AudiohealthError('Could not decode {}: {}'.format(audiofile, ex))
+        self.samplerate = self.source.samplerate
+        self.channels = self.source.channels
+        self.hop_size = self.source.hop_size
+        # Number of frames, which is only an estimate for some compressed formats.
+        self.frames = self.source.duration
+
+    def __iter__(self):
+        while True:
+            block, read = self.source.do_multi()
+            yield block[:, :read].T
+            if read < self.hop_size: break
+
+    def remix(self):
+        """
+        Yield float64 blocks of the first two channels mixed down to mono,
+        like "remix 1,2" of sox does.
+        """
+        for block in self:
+            yield remix(block)
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def remix(block):
+    """
+    Mix down the first two channels of a block to mono, as float64.
+    """
+    if block.shape[1] >= 2:
+        return block[:, :2].mean(axis=1, dtype=np.float64)
+    return block[:, 0].astype(np.float64)
+
+def collect(blocks, size=0, dtype=np.float64):
+    """
+    Concatenate 1-dimensional blocks into a single array, preallocated
+    to "size" samples and grown when the estimate turns out too small.
+    """
+    x = np.empty(size, dtype=dtype)
+    index = 0
+    for block in blocks:
+        if index + len(block) > len(x):
+            grown = np.empty(max(2 * len(x), index + len(block)), dtype=dtype)
+            grown[:index] = x[:index]
+            x = grown
+        x[index:index + len(block)] = block
+        index += len(block)
+    return x[:index]
+
+def rechunk(blocks, size):
+    """
+    Join consecutive 1-dimensional blocks into blocks of
+    at least "size" samples, except for the last one.
+    """
+    pending, count = [], 0
+    for block in blocks:
+        pending.append(block)
+        count += len(block)
+        if count >= size:
+            yield np.concatenate(pending)
+            pending, count = [], 0
+    if pending:
+        yield np.concatenate(pending)
+
+@profiled('resample_native')
+def resample_native(audiofile):
+    """
+    In-process equivalent of the sox chain within "resample()", i.e.
+    "remix 1,2 norm -3 sinc 30-3150 rate 6300", without spawning
+    any subprocesses or writing temporary files.
+
+    Returns the target samplerate and a float32 array with values
+    ranging from -1 to 1, on the same scale as "wav_to_dat()" uses.
+    """
+    # Remix: Mix down the first two channels to mono while decoding,
+    # block by block, so only the downsampled signal is held in memory.
+    with AudioDecoder(audiofile) as decoder:
+        return resample_blocks(decoder.remix(), decoder.samplerate, size=decoder.frames)
+
+def resample_blocks(blocks, samplerate, size=0):
+    """
+    Normalize, bandpass filter and resample the mono signal at "samplerate"
+    given as consecutive blocks, the part of "resample_native()" following
+    the decoder. "size" is the estimated number of samples of the signal.
+    """
+    # Lowpass and resample: A polyphase resampler with a Kaiser-windowed
+    # FIR filter (120 dB stopband attenuation) cutting off at the upper
+    # edge of the bandpass, which is the Nyquist frequency of the target.
+    # Highpass: Linear-phase FIR filter at the target samplerate. Both
+    # run block by block, with their delays compensated, so the outcome
+    # is the same as filtering the whole signal at once. The small blocks
+    # of the decoder are joined first, which saves most of the overhead.
+    resampler = StreamResampler(samplerate, aligned=True)
+    peak = 0.0
+
+    def resampled():
+        nonlocal peak
+        for block in rechunk(blocks, RESAMPLE_BLOCKSIZE):
+            if len(block):
+                peak = max(peak, float(np.abs(block).max()))
+            yield resampler(block)
+        yield resampler.flush()
+    x = collect(resampled(), size=-(-size * resampler.up // resampler.down), dtype=np.float32)
+
+    # Normalize: Peak level at -3 dBFS. Both filters are linear,
+    # so the gain is applied at the end, on the much smaller output.
+    if peak:
+        x *= np.float32(10 ** (NORM_DB / 20.0) / peak)
+    return SAMPLERATE, x
+
+def lowpass_filter(samplerate):
+    """
+    Design the anti-aliasing lowpass filter for resampling to SAMPLERATE.
+    Returns the upsampling and downsampling factors and the filter taps.
+    """
+    g = np.gcd(int(samplerate), SAMPLERATE)
+    up, down = SAMPLERATE // g, int(samplerate) // g
+    width = 0.05 * BANDPASS[1]
+    numtaps, beta = signal.kaiserord(120, width / (0.5 * samplerate * up))
+    taps = signal.firwin(numtaps | 1, BANDPASS[1] - width / 2, window=('kaiser', beta), fs=samplerate * up)
+    return up, down, taps * up
+
+def highpass_filter():
+    """
+    Design the highpass filter at the lower edge of the bandpass.
+    """
+    width = BANDPASS[0] * 2 / 3.0
+    numtaps, beta = signal.kaiserord(120, width / (0.5 * SAMPLERATE))
+    return signal.firwin(numtaps | 1, BANDPASS[0], window=('kaiser', beta), pass_zero=False, fs=SAMPLERATE)
+
+class StreamResampler(object):
+    """
+    Bandpass filter and resampler working incrementally, see "resample_blocks()".
+
+    Blocks of arbitrary size go in, while the filter state is carried over
+    from block to block, so the output does not depend on how the input is
+    chunked. Memory usage is bounded by the block size and the filter lengths.
+    There is no normalization, as the peak level is not known in advance.
+
+    By default, the filters are causal, so the output lags behind the input
+    by half the filter lengths. At the end of a stream, the samples held
+    back by the filters are dropped, which is less than a window of the
+    analyzer. With "aligned", the lag is compensated like "resample_poly()"
+    and "oaconvolve(mode='same')" of SciPy do on whole signals, and
+    "flush()" returns the samples held back, so the output is the same.
+    """
+
+    def __init__(self, samplerate, aligned=False):
+        self.up, self.down, self.lowpass = lowpass_filter(samplerate)
+        self.highpass = highpass_filter()
+
+        # Output samples of each filter to drop, which compensates their
+        # delay. The lowpass filter gets padded in front like within
+        # "resample_poly()", so its delay is a whole number of output samples.
+        self.skip = {'lowpass': 0, 'highpass': 0}
+        # Number of input samples, and of output samples returned by each filter so far.
+        self.frames = 0
+        self.emitted = {'lowpass': 0, 'highpass': 0}
+        if aligned:
+            if (self.up, self.down) != (1, 1):
+                half = (len(self.lowpass) - 1) // 2
+                pad = self.down - half % self.down
+                self.lowpass = np.concatenate([np.zeros(pad), self.lowpass])
+                self.skip['lowpass'] = (half + pad) // self.down
+            self.skip['highpass'] = (len(self.highpass) - 1) // 2
+
+        # Input samples still needed for upcoming output samples and
+        # their offset within the whole input stream. The offset is kept
+        # at a multiple of "down", so output samples fall onto integers.
+        self.history = np.zeros(0)
+        self.offset = 0
+        # Number of output samples produced by the lowpass filter so far.
+        self.produced = 0
+        # Trailing output samples of the lowpass filter, for the highpass filter.
+        self.tail = np.zeros(len(self.highpass) - 1)
+
+    def __call__(self, block):
+        return self.filter_highpass(self.filter_lowpass(np.asarray(block, dtype=np.float64)))
+
+    def filter_lowpass(self, block):
+        up, down = self.up, self.down
+        x = np.concatenate([self.history, block])
+        self.frames += len(block)
+
+        if (up, down) == (1, 1):
+            y = x
+            self.history = x[:0]
+            self.offset += len(x)
+        else:
+            # Output sample k corresponds to upsampled index k * down. Compute
+            # all output samples whose newest input sample is already available.
+            end = ((self.offset + len(x) - 1) * up) // down + 1
+            y = signal.upfirdn(self.lowpass, x, up, down)
+            first = self.produced - self.offset * up // down
+            y = y[first:first + end - self.produced]
+            self.produced = end
+
+            # Keep the input samples contributing to the next output sample.
+            keep = (end * down - len(self.lowpass) + 1) // up
+            keep = max(keep - keep % down, self.offset)
+            self.history = x[keep - self.offset:]
+            self.offset = keep
+
+        return self.drop('lowpass', y)
+
+    def filter_highpass(self, y):
+        # Highpass filter using overlap-save. For empty input, "mode='valid'"
+        # would swap the arguments, as the filter is longer than the tail.
+        if not len(y):
+            return y
+        z = signal.oaconvolve(np.concatenate([self.tail, y]), self.highpass, mode='valid')
+        self.tail = np.concatenate([self.tail, y])[len(y):]
+        return self.drop('highpass', z)
+
+    def drop(self, name, y):
+        count = min(self.skip[name], len(y))
+        self.skip[name] -= count
+        self.emitted[name] += len(y) - count
+        return y[count:]
+
+    def flush(self):
+        """
+        Return the output samples held back by the filters at the end of
+        a stream, for "aligned" resamplers. Afterwards, the output is as
+        long as the one of "resample_poly()".
+        """
+        up, down = self.up, self.down
+        frames = self.frames
+        total = -(-frames * up // down)
+
+        # Feed zeros, like the padding of "resample_poly()" and of
+        # "mode='same'", until all remaining output samples are computed.
+        remaining = max(total - self.emitted['lowpass'], 0)
+        needed = self.produced + self.skip['lowpass'] + remaining
+        y = self.filter_lowpass(np.zeros(max(-(-(needed - 1) * down // up) + 1 - frames, 0)))[:remaining]
+        remaining = max(total - self.emitted['highpass'], 0)
+        z = self.filter_highpass(np.concatenate([y, np.zeros(len(self.highpass) // 2)]))
+        return z[:remaining]
+
+    def state(self):
+        """
+        Capture the filter state, for resuming later on using "restore()".
+        """
+        return {'history': self.history, 'offset': self.offset, 'produced': self.produced, 'tail': self.tail}
+
+    def restore(self, state):
+        self.history = np.asarray(state['history'], dtype=np.float64)
+        self.offset = int(state['offset'])
+        self.produced = int(state['produced'])
+        self.tail = np.asarray(state['tail'], dtype=np.float64)
+def read_exactly(stream, size):
+    """
+    Read up to "size" bytes, retrying on short reads from pipes.
+    """
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def pcm_format(stream, samplerate=44100, channels=1, dtype='<i2'):
+    """
+    Determine the format of a PCM stream. When it starts with a RIFF/WAVE
+    header, the format is read from it and the stream is positioned at the
+    beginning of the sample data. Otherwise, the given format is assumed.
+
+    Returns samplerate, number of channels, NumPy dtype and any bytes
+    already consumed which belong to the sample data.
+    """
+    head = read_exactly(stream, 12)
+    if not (head[:4] == b'RIFF' and head[8:12] == b'WAVE'):
+        return samplerate, channels, np.dtype(dtype), head
+
+    while True:
+        chunk = read_exactly(stream, 8)
+        if len(chunk) < 8:
+            raise AudiohealthError('Unexpected end of stream while reading WAV header')
+        name, size = struct.unpack('<4sI', chunk)
+        if name == b'data':
+            return samplerate, channels, np.dtype(dtype), b''
+        data = read_exactly(stream, size + size % 2)
+        if name == b'fmt ':
+            tag, channels, samplerate, _, _, bits = struct.unpack('<HHIIHH', data[:16])
+            if tag == 0xFFFE:
+                tag = struct.unpack('<H', data[24:26])[0]
+            if tag == 3:
+                dtype = '<f{}'.format(bits // 8)
+            elif tag == 1 and bits in (8, 16, 32):
+                dtype = 'u1' if bits == 8 else '<i{}'.format(bits // 8)
+            else:
+                raise AudiohealthError('Unsupported WAV format {} with {} bits'.format(tag, bits))
+
+def pcm_scale(dtype):
+    """
+    Offset and factor scaling PCM samples of "dtype" to float values ranging from -1 to 1.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return 0, 1.0
+    bits = 8 * dtype.itemsize
+    return (2 ** (bits - 1) if dtype.kind == 'u' else 0), 1.0 / 2 ** (bits - 1)
+
+def pcm_to_float(samples):
+    """
+    Scale PCM samples of any integer or float dtype to float values ranging from -1 to 1.
+    """
+    offset, factor = pcm_scale(samples.dtype)
+    if offset:
+        return (samples.astype(np.float64) - offset) * factor
+    return samples.astype(np.float64) * factor
+
+def pcm_blocks(samples, blocksize=PCM_BLOCKSIZE, scale=1.0):
+    """
+    Convert PCM samples of any dtype to float32 values ranging from -1 to 1,
+    multiplied by "scale", block by block. Of stereo samples, the left channel
+    is taken. Each block is a view into the same scratch buffer, which gets
+    overwritten by the next block, so no copy of the whole signal is made.
+
+    Pages of memory-mapped samples are released after converting them,
+    so the resident set stays bounded, however long the file is.
+    """
+    offset, factor = pcm_scale(samples.dtype)
+    factor = np.float32(factor * scale)
+    scratch = np.empty(min(blocksize, len(samples)), dtype=np.float32)
+    for begin in range(0, len(samples), blocksize):
+        end = min(begin + blocksize, len(samples))
+        chunk = samples[begin:end]
+        block = scratch[:end - begin]
+        np.copyto(block, chunk[:, 0] if chunk.ndim == 2 else chunk, casting='unsafe')
+        if offset:
+            block -= offset
+        block *= factor
+        yield block
+        release_pages(samples, begin, end)
+
+def release_pages(samples, begin, end):
+    """
+    Drop the pages holding rows "begin" to "end" of memory-mapped samples,
+    as returned by "read_wav()", from the resident set. The mapping is
+    read-only, so the pages are just read again from the file when needed.
+    """
+    mapping = getattr(samples, '_mmap', None)
+    if mapping is None or not hasattr(mapping, 'madvise') or not samples.flags.c_contiguous:
+        return
+    row = samples.itemsize * (samples.shape[1] if samples.ndim == 2 else 1)
+    skip = samples.offset % mmap.ALLOCATIONGRANULARITY
+    low = (skip + begin * row) // mmap.PAGESIZE * mmap.PAGESIZE
+    high = (skip + end * row) // mmap.PAGESIZE * mmap.PAGESIZE
+    if high > low:
+        mapping.madvise(mmap.MADV_DONTNEED, low, high - low)
+
+def pcm_to_float32(samples, scale=1.0):
+    """
+    Like "pcm_to_float()", but into a float32 array, converted block by block
+    using "pcm_blocks()". Of stereo samples, the left channel is taken.
+    """
+    result = np.empty(len(samples), dtype=np.float32)
+    position = 0
+    for block in pcm_blocks(samples, scale=scale):
+        result[position:position + len(block)] = block
+        position += len(block)
+    return result
+
+def pcm16_level(samples):
+    """
+    Bring PCM samples of any dtype to the level of 16-bit samples, which the
+    thresholds of the power analysis refer to. 16-bit samples are returned as is.
+    """
+    if samples.dtype == np.int16:
+        return samples
+    return pcm_to_float32(samples, scale=2.0 ** 15)
+
+def read_pcm(stream, samplerate=44100, channels=1, dtype='<i2', blocksize=SAMPLERATE):
+    """
+    Read PCM audio from a binary stream, like stdin, in blocks of "blocksize" frames.
+
+    Yields the samplerate once, followed by float arrays of shape (frames, channels).
+    """
+    samplerate, channels, dtype, pending = pcm_format(stream, samplerate=samplerate, channels=channels, dtype=dtype)
+    yield samplerate
+    framesize = channels * dtype.itemsize
+    while True:
+        data = pending + read_exactly(stream, blocksize * framesize - len(pending))
+        usable = len(data) - len(data) % framesize
+        pending = data[usable:]
+        if usable:
+            yield pcm_to_float(np.frombuffer(data[:usable], dtype=dtype).reshape(-1, channels))
+        if len(data) < blocksize * framesize:
+            break
+
+class WindowAssembler(object):
+    """
+    Remix, filter and resample blocks of audio incrementally
+    and collect them into complete windows of WINDOW_LENGTH seconds each.
+
+    As the peak level of the whole recording is not known in advance,
+    each window gets normalized on its own, to -3 dBFS like sox does.
+    """
+
+    def __init__(self, samplerate):
+        self.resampler = StreamResampler(samplerate)
+        self.window = np.zeros(WINDOW_LENGTH * SAMPLERATE)
+        self.filled = 0
+
+    def __call__(self, block):
+        """
+        Feed a block of shape (frames, channels), returning the list of windows completed by it.
+        """
+        if block.shape[1] >= 2:
+            block = block[:, :2].mean(axis=1)
+        else:
+            block = block[:, 0]
+        y = self.resampler(block)
+        windows = []
+        while len(y):
+            count = min(len(self.window) - self.filled, len(y))
+            self.window[self.filled:self.filled + count] = y[:count]
+            self.filled += count
+            y = y[count:]
+            if self.filled == len(self.window):
+                peak = np.abs(self.window).max()
+                gain = 10 ** (NORM_DB / 20.0) / peak if peak else 1.0
+                windows.append((self.window * gain).astype(np.float32))
+                self.filled = 0
+        return windows
+
+    def state(self):
+        state = self.resampler.state()
+        state.update({'window': self.window[:self.filled], 'filled': self.filled})
+        return state
+
+    def restore(self, state):
+        self.resampler.restore(state)
+        self.filled = int(state['filled'])
+        self.window[:self.filled] = state['window']
+
+def stream_windows(blocks, samplerate):
+    """
+    Yield complete windows of WINDOW_LENGTH seconds from blocks of audio, see "WindowAssembler".
+    """
+    assembler = WindowAssembler(samplerate)
+    for block in blocks:
+        for window in assembler(block):
+            yield window
+
+def classify_windows(windows, analyzer=None, strategy=None, transport='text'):
+    """
+    Classify windows of WINDOW_LENGTH seconds one by one, yielding the states.
+    """
+    for window in windows:
+        for state in analyze_samples(window, analyzer=analyzer, strategy=strategy, transport=transport):
+            yield state
+
+def stream_analysis(blocks, samplerate, analyzer=None, strategy=None, transport='text'):
+    """
+    Analyze a stream of audio blocks window by window, yielding
+    each state as soon as the analyzer decided about it.
+    """
+    states = classify_windows(
+        stream_windows(blocks, samplerate), analyzer=analyzer, strategy=strategy, transport=transport)
+    for index, state in enumerate(states):
+        time_begin = index * WINDOW_LENGTH
+        yield {'time_begin': time_begin, 'time_end': time_begin + WINDOW_LENGTH, 'state': state}
+
+def load_checkpoint(checkpointfile):
+    """
+    Load the checkpoint of an incremental analysis, see "resume_analysis()".
+    Returns None when there is none yet.
+    """
+    if not os.path.exists(checkpointfile):
+        return None
+    with np.load(checkpointfile) as data:
+        checkpoint = json.loads(str(data['meta']))
+        checkpoint['filter'] = {name: data[name] for name in ['history', 'tail', 'window']}
+    checkpoint['filter'].update(checkpoint.pop('counters'))
+    return checkpoint
+
+def save_checkpoint(checkpointfile, checkpoint):
+    """
+    Write the checkpoint of an incremental analysis. The file
+    is replaced atomically, so an interrupted run leaves the
+    previous checkpoint intact.
+    """
+    state = checkpoint['filter']
+    meta = dict((name, value) for name, value in checkpoint.items() if name != 'filter')
+    meta['counters'] = {name: int(state[name]) for name in ['offset', 'produced', 'filled']}
+    tmpfile = checkpointfile + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        np.savez(f, meta=json.dumps(meta), history=state['history'], tail=state['tail'], window=state['window'])
+    os.replace(tmpfile, checkpointfile)
+
+def resume_analysis(audiofile, checkpointfile=None, analyzer=None, strategy=None, transport='text',
+                    blocksize=WINDOW_LENGTH * SAMPLERATE):
+    """
+    Analyze a WAV file which keeps growing, like the recordings of a running
+    recorder, incrementally. Only audio appended since the last run gets
+    processed, continuing with the filter state and the partial window
+    stored in the checkpoint file. So, the states are the same as those of
+    a single run over the whole file. Samples are processed like in stream
+    mode, i.e. each window is normalized on its own.
+
+    Returns all states so far, their chronology and the number of new states.
+    """
+    checkpointfile = checkpointfile or audiofile + CHECKPOINT_SUFFIX
+    params = {'strategy': strategy or DEFAULT_STRATEGY, 'analyzer': os.path.abspath(analyzer)}
+
+    with open(audiofile, 'rb') as f:
+        samplerate, channels, dtype, pending = pcm_format(f)
+        if pending:
+            raise AudiohealthError('Resuming needs a WAV file, {} is not'.format(audiofile))
+        data_start = f.tell()
+        framesize = channels * dtype.itemsize
+        audioformat = {'samplerate': samplerate, 'channels': channels, 'dtype': dtype.str}
+
+        # Detect recordings which have been replaced instead of appended to.
+        checkpoint = load_checkpoint(checkpointfile)
+        if checkpoint is not None:
+            f.seek(data_start)
+            fingerprint = hashlib.sha1(f.read(checkpoint['fingerprint_size'])).hexdigest()
+            if (checkpoint['params'], checkpoint['format'], checkpoint['fingerprint']) != (params, audioformat, fingerprint):
+                checkpoint = None
+
+        assembler = WindowAssembler(samplerate)
+        if checkpoint is None:
+            f.seek(data_start)
+            head = f.read(2 ** 16)
+            checkpoint = {
+                'params': params, 'format': audioformat, 'position': 0, 'states': [], 'chronology': [],
+                'fingerprint': hashlib.sha1(head).hexdigest(), 'fingerprint_size': len(head)}
+        else:
+            assembler.restore(checkpoint['filter'])
+
+        # Only process complete frames, the recorder might be in the middle of writing one.
+        available = os.fstat(f.fileno()).st_size - data_start - checkpoint['position']
+        available -= available % framesize
+        f.seek(data_start + checkpoint['position'])
+
+        def windows():
+            remaining = available
+            while remaining:
+                data = read_exactly(f, min(blocksize * framesize, remaining))
+                remaining -= len(data)
+                for window in assembler(pcm_to_float(np.frombuffer(data, dtype=dtype).reshape(-1, channels))):
+                    yield window
+
+        states = list(classify_windows(windows(), analyzer=analyzer, strategy=strategy, transport=transport))
+
+    checkpoint['chronology'] = extend_chronology(checkpoint['chronology'], states, start=len(checkpoint['states']))
+    checkpoint['states'] = checkpoint['states'] + states
+    checkpoint['position'] += available
+    checkpoint['filter'] = assembler.state()
+    save_checkpoint(checkpointfile, checkpoint)
+
+    return checkpoint['states'], checkpoint['chronology'], len(states)
+
+def write_wav(wavfile, samplerate, samples):
+    """
+    Write float samples ranging from -1 to 1 as 16-bit PCM .wav file, like sox does.
+    """
+    pcm = np.clip(np.round(samples * (2.0 ** 15)), -2 ** 15, 2 ** 15 - 1).astype(np.int16)
+    wav.write(wavfile, samplerate, pcm)
+
+@profiled('wav_to_dat')
+def wav_to_dat(audiofile, transport='text', outfile=None):
+    """
+    Convert a downsampled .wav file for consumption by osbh-audioanalyzer.
 
-def wav_to_dat(audiofile):
-    sampFreq, snd = wav.read(audiofile)
+    The .wav file is memory-mapped where possible and converted block by
+    block, see "pcm_blocks()", so memory usage does not depend on its length.
+    Samples are scaled according to their dtype, like 16, 24 or 32 bit
+    integers or floats, to values ranging from -1 to 1.
+    """
+    sampFreq, snd = read_wav(audiofile)
 
     duration = snd.shape[0] / sampFreq
     print("Duration: {}s".format(duration))
 
-    # Convert sound array to floating point values ranging from -1 to 1
-    # http://samcarcagno.altervista.org/blog/basic-sound-processing-python/
-    snd = snd / (2.0 ** 15)
+    outfile = outfile or audiofile + DAT_SUFFIX[transport]
+    with open(outfile, 'wb') as f:
+        for index, block in enumerate(pcm_blocks(snd)):
+            if transport == 'binary':
+                block.astype('<f4', copy=False).tofile(f)
+            else:
+                if index:
+                    f.write(b'\n')
+                block.tofile(f, "\n")
+    return outfile
 
-    outfile = audiofile + ".dat"
-    snd.tofile(outfile, "\n")
+@profiled('samples_to_dat')
+def samples_to_dat(samples, outfile, transport='text'):
+    """
+    Write samples for consumption by osbh-audioanalyzer.
 
+    The "text" transport writes one sample per line. The "binary" transport
+    writes raw little-endian float32 values, which is several times
+    smaller and does not need any formatting or parsing.
+    """
+    if transport == 'binary':
+        np.asarray(samples, dtype='<f4').tofile(outfile)
+    else:
+        samples.tofile(outfile, "\n")
     return outfile
 
+@functools.lru_cache(maxsize=8)
+def analyzer_transport(analyzer, transport):
+    """
+    Decide about the transport to use with "analyzer". The "binary" transport
+    needs an osbh-audioanalyzer build which reads raw float32 samples from
+    stdin when given "-" as file name. Builds without it, like the one from
+    the "inputfile-strategy" branch, fail to classify a window of silence
+    handed over that way, and fall back to the "text" transport.
+    """
+    if transport != 'binary':
+        return transport
+    if not os.path.exists(analyzer):
+        raise AudiohealthError('Can not find osbh-audioanalyzer at path {}'.format(analyzer))
+    silence = np.zeros(WINDOW_LENGTH * SAMPLERATE, dtype='<f4')
+    try:
+        probe = subprocess.run(
+            [analyzer, '-', DEFAULT_STRATEGY], input=silence.tobytes(),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
+        if probe.returncode == 0 and parse_states(probe.stdout):
+            return 'binary'
+    except (OSError, subprocess.TimeoutExpired, UnicodeDecodeError):
+        pass
+    sys.stderr.write('WARNING: {} does not read float32 samples from stdin, '
+                     'falling back to the "text" transport\n'.format(analyzer))
+    return 'text'
+
+def analyze_samples(samples, analyzer=None, strategy=None, transport='text'):
+    """
+    Classify samples held in memory using osbh-audioanalyzer. With the
+    "binary" transport, they are piped to its stdin as raw float32 values,
+    without touching the disk. Otherwise, or if the analyzer does not
+    support it, they are handed over as temporary text .dat file.
+    """
+    strategy = strategy or DEFAULT_STRATEGY
+    if not os.path.exists(analyzer):
+        raise AudiohealthError('Can not find osbh-audioanalyzer at path {}'.format(analyzer))
+
+    if analyzer_transport(analyzer, transport) == 'binary':
+        data = memoryview(np.ascontiguousarray(samples, dtype='<f4')).cast('B')
+        with PROFILER.stage('analyze'):
+            returncode, stdout = run_command('osbh-audioanalyzer', [analyzer, '-', strategy], input=data)
+        if returncode != 0:
+            raise AudiohealthError('osbh-audioanalyzer failed', returncode=returncode)
+        return parse_states(stdout)
+
+    tmpfile = NamedTemporaryFile(suffix=DAT_SUFFIX['text'], delete=False)
+    tmpfile.close()
+    try:
+        samples_to_dat(samples, tmpfile.name)
+        return analyze(tmpfile.name, analyzer=analyzer, strategy=strategy)
+    finally:
+        os.unlink(tmpfile.name)
+
 def analyze(datfile, analyzer=None, strategy=None):
-    strategy = strategy or 'lr-2.1'
+    strategy = strategy or DEFAULT_STRATEGY
+
+    # The transport is derived from the file name. Samples of .f32 files
+    # are piped to the analyzer, see "analyze_samples()".
+    if datfile.endswith(DAT_SUFFIX['binary']):
+        return analyze_samples(read_dat(datfile), analyzer=analyzer, strategy=strategy, transport='binary')
 
     # Run "osbh-audioanalyzer" command
     cmd = [analyzer, datfile, strategy]
     if not os.path.exists(analyzer):
-        print()
-        print('ERROR: Can not find osbh-audioanalyzer at path {}'.format(analyzer))
-        sys.exit(2)
+        raise AudiohealthError('Can not find osbh-audioanalyzer at path {}'.format(analyzer))
 
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        print()
-        print('ERROR: osbh-audioanalyzer failed')
-        print(stderr)
-        sys.exit(process.returncode)
+    with PROFILER.stage('analyze'):
+        returncode, stdout = run_command('osbh-audioanalyzer', cmd)
+    if returncode != 0:
+        raise AudiohealthError('osbh-audioanalyzer failed', returncode=returncode)
 
+    return parse_states(stdout)
+
+def parse_states(stdout):
+    """
+    Read the sequence of states from the output of osbh-audioanalyzer.
+    """
     states = stdout.decode('utf-8').split('\n')
 
     # Sanitize
@@ -102,74 +1150,188 @@ def analyze(datfile, analyzer=None, strategy=None):
 
     return states
 
-def report(states):
+async def analyze_async(datfile=None, analyzer=None, strategy=None, timeout=None, samples=None):
+    """
+    Like "analyze()", but as coroutine running osbh-audioanalyzer as async
+    subprocess. Its error output is part of any error. Instead of a datfile,
+    "samples" may be given, to be piped to the analyzer with the "binary"
+    transport, like the samples of .f32 files. The caller is expected to
+    have checked that the analyzer supports it, see "analyzer_transport()".
+    """
+    strategy = strategy or DEFAULT_STRATEGY
+    if not os.path.exists(analyzer):
+        raise AudiohealthError('Can not find osbh-audioanalyzer at path {}'.format(analyzer))
+
+    if samples is not None or datfile.endswith(DAT_SUFFIX['binary']):
+        if samples is None:
+            samples = read_dat(datfile)
+        data = memoryview(np.ascontiguousarray(samples, dtype='<f4')).cast('B')
+        returncode, stdout, stderr = await run_command_async(
+            'osbh-audioanalyzer', [analyzer, '-', strategy], input=data, timeout=timeout)
+    else:
+        returncode, stdout, stderr = await run_command_async(
+            'osbh-audioanalyzer', [analyzer, datfile, strategy], timeout=timeout)
+    if returncode != 0:
+        raise AudiohealthError('osbh-audioanalyzer failed\n{}'.format(
+            stderr.decode('utf-8', 'replace').strip()), returncode=returncode)
 
-    # The audio is chunked into segments of 10 seconds each, see:
-    #   - tools/osbh-audioanalyzer/params.h: float windowLength=2; //Window Length in s
-    #   - tools/osbh-audioanalyzer/main.cpp: DetectedStates.size()==5
-    window_length = 2 * 5
+    return parse_states(stdout)
 
-    chronology = []
-    aggregated = {}
-    current = None
-    applied = False
-    for i, state in enumerate(states):
+def read_dat(datfile):
+    """
+    Read samples from a .dat file, either as text or as raw float32.
+    """
+    if datfile.endswith(DAT_SUFFIX['binary']):
+        return np.fromfile(datfile, dtype='<f4')
+    return np.fromfile(datfile, dtype=np.float64, sep='\n')
 
-        aggregated.setdefault(state, 0)
-        aggregated[state] += window_length
+def encode_states(states):
+    """
+    Convert a sequence of states into small integer codes.
+    Returns the list of distinct states and the codes referring to them.
+    """
+    if not len(states):
+        return [], np.zeros(0, dtype=np.uint8)
+    labels, codes = np.unique(np.asarray(states), return_inverse=True)
+    return labels.tolist(), codes.astype(np.min_scalar_type(len(labels)))
+
+def run_lengths(codes):
+    """
+    Run-length encode a sequence of codes.
+    Returns the start index, the length and the code of each run.
+    """
+    codes = np.asarray(codes)
+    starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]])) if len(codes) else np.zeros(0, dtype=np.int64)
+    lengths = np.diff(np.append(starts, len(codes)))
+    return starts, lengths, codes[starts]
+
+def timeline(states):
+    """
+    Compress the sequence of states into a chronology of
+    contiguous segments and aggregate the total duration per state.
+
+    States with the same total duration are ordered by first appearance.
+    """
+    window_length = WINDOW_LENGTH
 
-        applied = False
-        time_begin = i * window_length
-        time_end   = time_begin + window_length
-        if state == current:
-            chronology[-1].update({'time_end': time_end})
+    labels, codes = encode_states(states)
+    starts, lengths, values = run_lengths(codes)
+
+    chronology = [
+        {'time_begin': time_begin, 'time_end': time_end, 'state': labels[value]}
+        for time_begin, time_end, value in zip(
+            (starts * window_length).tolist(), ((starts + lengths) * window_length).tolist(), values.tolist())]
+
+    totals = np.bincount(codes, minlength=len(labels)) * window_length
+    first = np.full(len(labels), len(codes))
+    np.minimum.at(first, values, starts)
+    order = np.lexsort((first, -totals))
+    aggregated_sorted = [(labels[index], int(totals[index])) for index in order]
+
+    return chronology, aggregated_sorted
+
+def summarize(states, bucket=3600):
+    """
+    Aggregate the total duration per state within buckets
+    of "bucket" seconds, like hours or days.
+
+    Like with "timeline()", states with the same total duration
+    are ordered by first appearance within their bucket.
+    """
+    window_length = WINDOW_LENGTH
+
+    labels, codes = encode_states(states)
+    buckets = np.arange(len(codes)) * window_length // bucket
+    count = int(buckets[-1]) + 1 if len(codes) else 0
+    totals = np.bincount(buckets * len(labels) + codes, minlength=count * len(labels))
+    totals = totals.reshape(count, len(labels)) * window_length
+
+    first = np.full((count, len(labels)), len(codes))
+    np.minimum.at(first, (buckets, codes), np.arange(len(codes)))
+
+    summary = []
+    orders = np.lexsort((first, -totals))
+    for index, (row, order) in enumerate(zip(totals.tolist(), orders.tolist())):
+        summary.append({
+            'time_begin': index * bucket,
+            'time_end': min((index + 1) * bucket, len(codes) * window_length),
+            'aggregated': [{'state': labels[i], 'duration': row[i]} for i in order if row[i]],
+        })
+    return summary
+
+def bar(duration, scale=1):
+    """
+    Visualize a duration as bar of "=" characters, one per "scale" windows.
+    """
+    return int(duration / WINDOW_LENGTH / scale) * "="
+
+def extend_chronology(chronology, states, start=0):
+    """
+    Append states to a chronology as built by "timeline()", where the first
+    of them is window number "start". Extends the last segment if its state
+    continues, so the outcome is the same as compressing all states at once.
+    """
+    chronology = [dict(entry) for entry in chronology]
+    for i, state in enumerate(states, start):
+        time_begin = i * WINDOW_LENGTH
+        time_end   = time_begin + WINDOW_LENGTH
+        if chronology and chronology[-1]['state'] == state and chronology[-1]['time_end'] == time_begin:
+            chronology[-1]['time_end'] = time_end
         else:
-            entry = {'time_begin': time_begin, 'time_end': time_end, 'state': state}
-            chronology.append(entry)
-            current = state
-            applied = True
+            chronology.append({'time_begin': time_begin, 'time_end': time_end, 'state': state})
+    return chronology
 
-    # Properly handle the last state
-    if chronology and not applied:
-        chronology[-1].update({'time_end': time_end})
+@profiled('report')
+def report(states, limit=None, bucket=None):
+    """
+    Print the report about a sequence of states.
+
+    With "limit", at most this many states and segments are listed and
+    bars are scaled to at most this many characters, so the size of the
+    report is bounded for any length of input. With "bucket", the total
+    duration per state is also summarized within buckets of this many
+    seconds, like hours or days.
+    """
+    chronology, aggregated_sorted = timeline(states)
 
+    scale = 1
+    if limit and aggregated_sorted:
+        scale = max(1, -(-aggregated_sorted[0][1] // WINDOW_LENGTH // limit))
 
     print('==================')
     print('Sequence of states')
     print('==================')
-    print(', '.join(states))
+    print(', '.join(states[:limit]))
+    if limit and len(states) > limit:
+        print('... and {} more'.format(len(states) - limit))
     print()
 
     print('===================')
     print('Compressed timeline')
     print('===================')
-    for i, entry in enumerate(chronology):
-        duration = None
-        try:
-            #duration = chronology[i+1]['time'] - chronology[i]['time']
-            duration = entry['time_end'] - entry['time_begin']
-        except IndexError:
-            pass
-        entry['duration'] = duration
-        entry['duration_vis'] = None
-        if duration:
-            entry['duration_vis'] = int(duration / window_length) * "="
-
-        #line = '{time:3}t {state:15} {duration_vis}'.format(**entry)
-        line = '{time_begin:3}s - {time_end:3}s   {state:15} {duration_vis}'.format(**entry)
-        print(line)
+    print_timeline(chronology[:limit], scale=scale)
+    if limit and len(chronology) > limit:
+        print('... and {} more segments'.format(len(chronology) - limit))
     print()
 
     print('==============')
     print('Total duration')
     print('==============')
-    aggregated_sorted = sorted(aggregated.items(), key=itemgetter(1), reverse=True)
     for state, duration in aggregated_sorted:
-        duration_vis = int(duration / window_length) * "="
+        duration_vis = bar(duration, scale)
         line = '{duration:10}s   {state:15} {duration_vis}'.format(**locals())
         print(line)
     print()
 
+    if bucket:
+        print('=======')
+        print('Summary')
+        print('=======')
+        for entry in summarize(states, bucket):
+            totals = ', '.join('{state} ({duration}s)'.format(**item) for item in entry['aggregated'])
+            print('{time_begin:8}s - {time_end:8}s   {totals}'.format(totals=totals, **entry))
+        print()
+
     print('======')
     print('Result')
     print('======')
@@ -197,75 +1359,324 @@ def report(states):
 
     print()
 
+def print_timeline(chronology, scale=1):
+    for i, entry in enumerate(chronology):
+        duration = None
+        try:
+            #duration = chronology[i+1]['time'] - chronology[i]['time']
+            duration = entry['time_end'] - entry['time_begin']
+        except IndexError:
+            pass
+        entry['duration'] = duration
+        entry['duration_vis'] = None
+        if duration:
+            entry['duration_vis'] = bar(duration, scale)
+
+        #line = '{time:3}t {state:15} {duration_vis}'.format(**entry)
+        line = '{time_begin:3}s - {time_end:3}s   {state:15} {duration_vis}'.format(**entry)
+        print(line)
+
+def consensus(results):
+    """
+    Combine the sequences of states of multiple strategies by majority vote.
+
+    Returns the majority state per window, the share of strategies agreeing
+    with it per window, and the share of windows each strategy agrees with
+    the majority. Ties are resolved in favor of the strategy listed first.
+    """
+    strategies = list(results)
+    size = min(len(states) for states in results.values()) if results else 0
+    majority = []
+    agreement = []
+    for i in range(size):
+        votes = Counter(results[strategy][i] for strategy in strategies)
+        count = max(votes.values())
+        state = next(results[strategy][i] for strategy in strategies if votes[results[strategy][i]] == count)
+        majority.append(state)
+        agreement.append(count / float(len(strategies)))
+
+    return {
+        'strategies': strategies,
+        'majority': majority,
+        'agreement': agreement,
+        'unanimous': sum(1 for value in agreement if value == 1.0),
+        'windows': size,
+        'by_strategy': {
+            strategy: sum(1 for i in range(size) if results[strategy][i] == majority[i]) / float(size or 1)
+            for strategy in strategies},
+    }
+
+def report_strategies(results):
+    """
+    Report the timelines of multiple strategies and how well they agree.
+    The detailed report is based on the majority vote of all strategies.
+    """
+    combined = consensus(results)
+
+    print('====================')
+    print('Timeline by strategy')
+    print('====================')
+    for strategy, states in results.items():
+        print(emphasize(strategy))
+        chronology, aggregated_sorted = timeline(states)
+        print_timeline(chronology)
+        print()
+
+    print('=========')
+    print('Agreement')
+    print('=========')
+    print('All strategies agree on {unanimous} of {windows} windows.'.format(**combined))
+    for strategy, share in combined['by_strategy'].items():
+        print('{strategy:10} agrees with the majority on {percent:5.1f}% of windows'.format(strategy=strategy, percent=share * 100))
+    print()
+
+    print('Report of majority vote')
+    print()
+    report(combined['majority'])
+
+    return combined
+
+def report_data(states, limit=None, bucket=None):
+    """
+    Structured equivalent of "report()", suitable for JSON serialization.
+    """
+    chronology, aggregated_sorted = timeline(states)
+    data = {
+        'window_length': WINDOW_LENGTH,
+        'states': states[:limit],
+        'chronology': [
+            {'time_begin': entry['time_begin'], 'time_end': entry['time_end'], 'state': entry['state']}
+            for entry in chronology[:limit]],
+        'aggregated': [{'state': state, 'duration': duration} for state, duration in aggregated_sorted],
+    }
+    if limit:
+        data['windows'] = len(states)
+        data['segments'] = len(chronology)
+    if bucket:
+        data['summary'] = summarize(states, bucket)
+    return data
+
+def emit(record, format='json', stream=None):
+    """
+    Write a record as pretty-printed JSON document or as a single NDJSON line.
+    """
+    stream = stream or sys.stdout
+    if format == 'ndjson':
+        stream.write(json.dumps(record) + '\n')
+    else:
+        stream.write(json.dumps(record, indent=2) + '\n')
+    stream.flush()
+
+def quiet(format):
+    """
+    Divert any textual output to stderr when emitting
+    structured output, so stdout stays machine-readable.
+    """
+    if format == 'text':
+        return nullcontext()
+    return redirect_stdout(sys.stderr)
+
 def emphasize(text):
     return color(text, fg='yellow', style='bold')
 
+def figure(**kwargs):
+    """
+    Create a figure rendered by Agg, without going through pyplot.
+    It is not registered with pyplot, so it is released as soon as it
+    is not referenced anymore, even within long-running processes.
 
-# https://github.com/aubio/aubio/blob/master/python/demos/demo_spectrogram.py
-def spectrogram(audiofile, samplerate=0):
-    win_s = 512                                        # fft window size
-    hop_s = win_s // 2                                 # hop size
-    fft_s = win_s // 2 + 1                             # spectrum bins
+    Imports matplotlib lazily, as it is only needed for rendering images
+    and takes a considerable amount of time to import.
+    """
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        raise AudiohealthError('matplotlib not available. Will not be able to generate images.')
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+def colormap(name):
+    """
+    Lookup table of a matplotlib colormap, as uint8 RGB values.
+    """
+    import matplotlib
+    cmap = matplotlib.colormaps[name]
+    return (cmap(np.linspace(0, 1, cmap.N))[:, :3] * 255).round().astype(np.uint8)
 
-    audio_data = aubio.source(audiofile, samplerate, hop_s)  # source file
-    if samplerate == 0:
-        samplerate = audio_data.samplerate
-    pv = aubio.pvoc(win_s, hop_s)                            # phase vocoder
-    specgram = np.zeros([0, fft_s], dtype=aubio.float_type)     # numpy array to store spectrogram
+# matplotlib is not thread-safe, so images are rendered one at a time
+# when stages run concurrently, see "analyze_all()".
+MATPLOTLIB_LOCK = threading.Lock()
 
-    # analysis
-    while True:
-        samples, read = audio_data()                     # read file
-        specgram = np.vstack((specgram,pv(samples).norm))   # store new norm vector
-        if read < audio_data.hop_size: break
+# Spectrograms bigger than this are computed into a memory-mapped temporary file.
+SPECTROGRAM_MEMMAP_BYTES = 512 * 1024 ** 2
 
-    # plotting
-    #fig = plt.imshow(log10(specgram.T + .001), origin = 'bottom', aspect = 'auto', cmap=plt.cm.gray_r)
-    #fig = plt.imshow(log10(specgram.T + .001), origin = 'bottom', aspect = 'auto', cmap=plt.cm.gray_r)
+def allocate_frames(frames, bins, memmap=False):
+    """
+    Allocate a float32 array for spectrogram frames, either in memory
+    or backed by an anonymous temporary file for huge recordings.
+    """
+    if memmap:
+        return np.memmap(TemporaryFile(), dtype=np.float32, mode='w+', shape=(frames, bins))
+    return np.empty((frames, bins), dtype=np.float32)
 
-    plt.figure(figsize=(15, 10))
-    fig = plt.imshow(np.log10(specgram.T + .001), origin = 'lower', aspect = 'auto', cmap=plt.cm.gray_r)
+class SpectrogramBuilder(object):
+    """
+    Incremental magnitude spectrogram, fed with blocks of audio of any
+    size and number of channels, see "compute_spectrogram()".
 
-    #print(dir(plt.cm))
+    "frames" is the (estimated) number of frames of the whole recording,
+    so the spectrogram can be preallocated and binned on the fly.
+    """
 
-    #fig = plt.imshow(log10(specgram.T + .001), origin = 'bottom', size=800)
-    #plt.pcolormesh(t, f, Sxx)
-    #plt.pcolormesh(specgram.T)
+    win_s = 512                                        # fft window size
+    hop_s = win_s // 2                                 # hop size
+    fft_s = win_s // 2 + 1                             # spectrum bins
 
-    #print(dir(colors))
+    def __init__(self, samplerate, frames, max_frames=None, memmap=None):
+        self.samplerate = samplerate
+        self.pv = aubio.pvoc(self.win_s, self.hop_s)   # phase vocoder
+
+        # The last hop is read partially, so there is one frame more than full hops.
+        # Compressed formats might only report an estimate, so still be prepared to grow.
+        frames_estimated = frames // self.hop_s + 1
+        self.bin_size = 1
+        if max_frames and frames_estimated > max_frames:
+            self.bin_size = -(-frames_estimated // max_frames)
+        size = -(-frames_estimated // self.bin_size)
+        if memmap is None:
+            memmap = size * self.fft_s * 4 > SPECTROGRAM_MEMMAP_BYTES
+        self.memmap = memmap
+        self.specgram = allocate_frames(size, self.fft_s, memmap=memmap)
+
+        self.index = 0
+        self.accumulator = np.zeros(self.fft_s, dtype=np.float64)
+        self.count = 0
+        self.samples = np.zeros(self.hop_s, dtype=np.float32)
+        self.filled = 0
+
+    def __call__(self, block):
+        mono = block.mean(axis=1)                      # mix down all channels
+        offset = 0
+        while offset < len(mono):
+            count = min(self.hop_s - self.filled, len(mono) - offset)
+            self.samples[self.filled:self.filled + count] = mono[offset:offset + count]
+            self.filled += count
+            offset += count
+            if self.filled == self.hop_s:
+                self.process(last=False)
+
+    def process(self, last):
+        self.samples[self.filled:] = 0
+        self.filled = 0
+        self.accumulator += self.pv(self.samples).norm # accumulate norm vector into current bin
+        self.count += 1
+        if self.count == self.bin_size or last:
+            if self.index == len(self.specgram):
+                grown = allocate_frames(max(2 * len(self.specgram), 1), self.fft_s, memmap=self.memmap)
+                grown[:self.index] = self.specgram
+                self.specgram = grown
+            self.specgram[self.index] = self.accumulator / self.count  # store new norm vector
+            self.index += 1
+            self.accumulator[:] = 0
+            self.count = 0
+
+    def finish(self):
+        """
+        Process the last, partial hop.
+        Returns the spectrogram, the time step per frame and the samplerate.
+        """
+        self.process(last=True)
+        time_step = self.hop_s * self.bin_size / float(self.samplerate)
+        return self.specgram[:self.index], time_step, self.samplerate
+
+@profiled('compute_spectrogram')
+def compute_spectrogram(audiofile, samplerate=0, max_frames=None, memmap=None):
+    """
+    Compute the magnitude spectrogram of audiofile in a single streaming pass.
 
-    #norm = colors.LogNorm(vmin=specgram.T.min(), vmax=specgram.T.max())
-    #norm = colors.LogNorm(vmin=specgram.min(), vmax=specgram.max())
+    The number of frames is derived from the duration of the source up front,
+    so frames are written into a preallocated float32 array instead of growing
+    it on each hop. When "max_frames" is given, consecutive frames are averaged
+    into time bins on the fly, so the result never exceeds this many frames.
+    When "memmap" is not given, it is enabled automatically for results
+    bigger than SPECTROGRAM_MEMMAP_BYTES.
 
-    #norm = colors.SymLogNorm(linthresh=0.03, linscale=0.03, vmin=specgram.min(), vmax=specgram.max())
-    norm = colors.SymLogNorm(linthresh=0.08, linscale=0.1, vmin=specgram.min(), vmax=specgram.max())
+    Returns the spectrogram, the time step per frame and the samplerate.
+    """
+    with AudioDecoder(audiofile, samplerate) as decoder:
+        builder = SpectrogramBuilder(decoder.samplerate, decoder.frames, max_frames=max_frames, memmap=memmap)
+        for block in decoder:
+            builder(block)
+    return builder.finish()
+
+# https://github.com/aubio/aubio/blob/master/python/demos/demo_spectrogram.py
+@profiled('spectrogram')
+def spectrogram(audiofile, samplerate=0, max_frames=None):
+    specgram, time_step, samplerate = compute_spectrogram(audiofile, samplerate=samplerate, max_frames=max_frames)
 
-    #bounds = np.linspace(-1, 1, 10)
-    #norm = colors.BoundaryNorm(boundaries=bounds, ncolors=256)
+    total_time = len(specgram) * time_step
+    outstr = "total time: %0.2fs" % total_time
+    print(outstr + ", samplerate: %.2fkHz" % (samplerate / 1000.0))
 
-    #norm = colors.PowerNorm(gamma=1./2.)
-    #norm = colors.PowerNorm(gamma=0.25)
+    with MATPLOTLIB_LOCK:
+        return render_spectrogram(specgram, time_step, samplerate, title=os.path.basename(audiofile))
 
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='PuBu_r')
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='PuBu_r')
+def bin_frames(specgram, width):
+    """
+    Average consecutive frames of a spectrogram into at most "width" time bins.
+    """
+    if len(specgram) <= width:
+        return np.asarray(specgram, dtype=np.float64)
+    bin_size = -(-len(specgram) // width)
+    edges = np.arange(0, len(specgram), bin_size)
+    sums = np.add.reduceat(specgram, edges, axis=0, dtype=np.float64)
+    counts = np.diff(np.append(edges, len(specgram)))
+    return sums / counts[:, np.newaxis]
+
+def symlog(x, linthresh, linscale):
+    """
+    Symmetric logarithm with base 10, linear within +/- linthresh,
+    the transformation of matplotlib's "SymLogNorm".
+    """
+    linscale = linscale / (1.0 - 10 ** -1)
+    x = np.asarray(x, dtype=np.float64)
+    magnitude = np.abs(x)
+    logarithmic = np.sign(x) * linthresh * (linscale + np.log10(np.maximum(magnitude, linthresh) / linthresh))
+    return np.where(magnitude <= linthresh, x * linscale, logarithmic)
 
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='RdBu_r')
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='RdBu')
+def colorize(values, vmin, vmax, lut, linthresh=0.08, linscale=0.1):
+    """
+    Map values to RGB colors through a symmetric logarithmic
+    normalization between vmin and vmax and a lookup table.
+    """
+    low, high = symlog([vmin, vmax], linthresh, linscale)
+    normalized = (symlog(values, linthresh, linscale) - low) / ((high - low) or 1.0)
+    indices = np.clip((normalized * len(lut)).astype(np.intp), 0, len(lut) - 1)
+    return lut[indices]
 
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='gnuplot2')
-    plt.pcolormesh(specgram.T, norm=norm, cmap='inferno')
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='hot_r')
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='copper')
-    #plt.pcolormesh(specgram.T, norm=norm, cmap='seismic')
+@profiled('render_spectrogram')
+def render_spectrogram(specgram, time_step, samplerate, title=None):
+    """
+    Render the spectrogram as .png file and return its name.
 
-    ax = fig.axes
+    Frames are binned down to the width of the plot in pixels first,
+    then colored using NumPy, so matplotlib only draws a single image
+    of the final size, regardless of the duration of the recording.
+    """
+    fig = figure(figsize=(15, 10))
+    ax = fig.add_subplot()
+
+    # Color scale of the whole spectrogram, mapped logarithmically with
+    # a linear region around zero, using the "inferno" colormap.
+    width = max(int(np.ceil(ax.get_window_extent().width)), 1)
+    image = colorize(bin_frames(specgram, width).T, specgram.min(), specgram.max(), colormap('inferno'))
+    ax.imshow(image, origin='lower', aspect='auto', interpolation='nearest',
+              extent=(0, len(specgram), 0, len(specgram[0])))
     ax.axis([0, len(specgram), 0, len(specgram[0])])
 
     # show axes in Hz and seconds
-    time_step = hop_s / float(samplerate)
-    total_time = len(specgram) * time_step
-    outstr = "total time: %0.2fs" % total_time
-    print(outstr + ", samplerate: %.2fkHz" % (samplerate / 1000.0))
     n_xticks = 10
     n_yticks = 10
 
@@ -280,7 +1691,6 @@ def spectrogram(audiofile, samplerate=0):
         # get the corresponding positions
         ticks_positions = [ ticks_labels[n] / step for n in range(n_ticks) ] + [ top_pos ]
         # convert to string
-        #ticks_labels = [  "%.1f" % x for x in ticks_labels ]
         ticks_labels = [  "%i" % x for x in ticks_labels ]
         # return position, label tuple to use with x/yticks
         return ticks_positions, ticks_labels
@@ -290,33 +1700,88 @@ def spectrogram(audiofile, samplerate=0):
     ax.set_xticks(x_ticks)
     ax.set_xticklabels(x_labels)
 
-    #y_ticks, y_labels = get_rounded_ticks(len(specgram[0]), (samplerate / 1000. / 2.) / len(specgram[0]), n_yticks)
     y_ticks, y_labels = get_rounded_ticks(len(specgram[0]), (samplerate / 2.0) / len(specgram[0]), n_yticks)
-    #y_ticks, y_labels = get_rounded_ticks(len(specgram[0]), 1, n_yticks)
     ax.set_yticks(y_ticks)
     ax.set_yticklabels(y_labels)
-    #ax.set_yticks(range(0, 3150, 100))
-    #print len(specgram), len(specgram[0]), max(specgram[0])
-    #plt.yticks(range(0, 3151, 100))
 
     ax.set_ylabel('Frequency (Hz)')
     ax.set_xlabel('Time (s)')
-    ax.set_title(os.path.basename(audiofile))
+    ax.set_title(title)
     for item in ([ax.title, ax.xaxis.label, ax.yaxis.label] +
             ax.get_xticklabels() + ax.get_yticklabels()):
         item.set_fontsize('x-small')
 
-    #return fig
-
     tmpfile = NamedTemporaryFile(suffix='.png', delete=False)
-    plt.savefig(tmpfile.name)
-    #plt.show()
+    fig.savefig(tmpfile.name)
 
     return tmpfile.name
 
-def power_spectrum(wavfile):
+def read_wav(wavfile):
+    """
+    Memory-map the .wav file if possible, so samples are
+    only paged in when accessed. Not all formats support it.
+    """
+    try:
+        return wav.read(wavfile, mmap=True)
+    except ValueError:
+        return wav.read(wavfile)
+
+def welch(x, fs, window='flattop', nperseg=WELCH_NPERSEG, blocksize=256):
+    """
+    Streaming variant of "signal.welch(x, fs, window, nperseg, scaling='spectrum')".
+
+    Segments are processed in blocks of "blocksize" segments, while the
+    averaged periodogram is accumulated incrementally. Each block starts
+    exactly at its first segment, so the overlap across block boundaries
+    is the same as within a block. Together with a memory-mapped input,
+    peak memory usage is bounded by "blocksize * nperseg" samples,
+    independently of the length of the input.
+    """
+
+    # Let SciPy handle the degenerated case of inputs shorter than a segment.
+    if len(x) < nperseg:
+        return signal.welch(x, fs, window, nperseg, scaling='spectrum')
+
+    noverlap = nperseg // 2
+    step = nperseg - noverlap
+    segments = (len(x) - noverlap) // step
+    win = signal.get_window(window, nperseg)
+
+    accumulator = np.zeros(nperseg // 2 + 1, dtype=np.float64)
+    for first in range(0, segments, blocksize):
+        count = min(blocksize, segments - first)
+        start = first * step
+        block = np.asarray(x[start:start + (count - 1) * step + nperseg], dtype=np.float64)
+        block = np.lib.stride_tricks.sliding_window_view(block, nperseg)[::step]
+
+        # Detrend ("constant"), apply window and accumulate periodograms.
+        block = (block - block.mean(axis=1, keepdims=True)) * win
+        accumulator += np.sum(np.abs(np.fft.rfft(block, axis=1)) ** 2, axis=0)
+
+    # Average, scale to power spectrum and convert to one-sided spectrum.
+    Pxx = accumulator / (segments * win.sum() ** 2)
+    if nperseg % 2:
+        Pxx[1:] *= 2
+    else:
+        Pxx[1:-1] *= 2
+
+    f = np.fft.rfftfreq(nperseg, 1.0 / fs)
+    return f, Pxx
+
+@profiled('compute_power_spectrum')
+def compute_power_spectrum(wavfile=None, samplerate=None, samples=None):
+    """
+    Compute the power spectrum of the left channel, either
+    from a .wav file or from samples already in memory.
+    """
 
-    fs, x = wav.read(wavfile)
+    level = 1.0
+    if samples is None:
+        fs, x = read_wav(wavfile)
+        # Scale the spectrum instead of the samples, to the level of 16-bit samples.
+        level = (pcm_scale(x.dtype)[1] * 2 ** 15) ** 2
+    else:
+        fs, x = samplerate, samples
 
     # From stereo file, take the left channel.
     if x.ndim == 2:
@@ -335,62 +1800,415 @@ def power_spectrum(wavfile):
 
     # Compute power spectrum
     # https://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.signal.welch.html
-    f, Pxx_spec = signal.welch(x, fs, 'flattop', 1024, scaling='spectrum')
-    Pxx_spec = Pxx_spec
+    f, Pxx = welch(x, fs, 'flattop', WELCH_NPERSEG)
+    return f, Pxx * level if level != 1.0 else Pxx
 
-    # Compute peaks in power spectrum
+def find_peaks(f, Pxx_spec):
+    """
+    Find peaks in power spectrum, returning their frequencies and power.
+    """
     #peak_indices = signal.find_peaks_cwt(Pxx_spec, np.arange(3, 15), min_snr=0.1)
     peak_indices = signal.argrelmax(Pxx_spec)
     #peak_indices = signal.argrelextrema(Pxx_spec, np.greater)
     peak_freq  = f[peak_indices]
     peak_power = Pxx_spec[peak_indices]
+    return peak_freq, peak_power
 
+def band_bins(f, bands=(BAND250, BAND500)):
+    """
+    Indices of the frequency bins within each band, plus one bin
+    on either side, so peaks at the band edges can be detected.
+    """
+    ranges = []
+    for low, high in bands:
+        inside = np.flatnonzero((f >= low) & (f <= high))
+        ranges.append(np.arange(max(inside[0] - 1, 0), min(inside[-1] + 2, len(f))))
+    return ranges
 
-    # Plot power spectrum and peaks
-    #plt.rcParams.update({'font.size': 10})
-    plt.rc('xtick', labelsize=10)
-    plt.figure()
+def band_spectrum(x, fs, bands=(BAND250, BAND500), window='flattop', nperseg=WELCH_NPERSEG, blocksize=4096):
+    """
+    Band-limited counterpart of "welch()": Compute the periodogram of each
+    segment only at the frequency bins around "bands", as a matrix product
+    of the signal with the windowed DFT basis of those bins, like a bank
+    of Goertzel filters.
+
+    As segments overlap by half, the signal is cut into half segments,
+    which are multiplied with both halves of the basis once. The DFT of a
+    segment is the sum of the first half of one and the second half of
+    the next product. Detrending ("constant") is folded in by subtracting
+    the response to the segment mean, which is the column sum of the basis.
+
+    Returns the frequencies of the bins, grouped per band, and the power of
+    each segment at each bin, scaled like "welch()". Averaging the segments
+    gives the same values as the full spectrum at these bins.
+    """
+    half = nperseg // 2
+    segments = max(len(x) // half - 1, 0)
+    win = signal.get_window(window, nperseg)
+
+    f = np.fft.rfftfreq(nperseg, 1.0 / fs)
+    ranges = band_bins(f, bands)
+    bins = np.concatenate(ranges)
+    columns = 2 * len(bins)
+
+    # Real and imaginary parts of the windowed DFT at the selected bins.
+    phase = 2 * np.pi * np.outer(np.arange(nperseg), bins) / nperseg
+    basis = np.hstack([np.cos(phase), -np.sin(phase)]) * win[:, None]
+    halves = np.hstack([basis[:half], basis[half:]])
+    response = basis.sum(axis=0)
+
+    power = np.empty((segments, len(bins)))
+    for first in range(0, segments, blocksize):
+        count = min(blocksize, segments - first)
+        block = np.asarray(x[first * half:(first + count + 1) * half], dtype=np.float64).reshape(count + 1, half)
+        products = block @ halves
+        spectrum = products[:-1, :columns] + products[1:, columns:]
+        sums = block.sum(axis=1)
+        spectrum -= ((sums[:-1] + sums[1:]) / nperseg)[:, None] * response
+        power[first:first + count] = spectrum[:, :len(bins)] ** 2 + spectrum[:, len(bins):] ** 2
+
+    # Scale to power spectrum and convert to one-sided spectrum.
+    scale = np.where((bins == 0) | ((nperseg % 2 == 0) & (bins == nperseg // 2)), 1.0, 2.0)
+    power *= scale / win.sum() ** 2
+
+    return [f[indices] for indices in ranges], power
+
+def band_verdicts(freqs, power):
+    """
+    Vectorized equivalent of "find_peaks()" and "analyze_peaks()" restricted to
+    the two bands, for many spectra at once. "power" holds one row per spectrum,
+    with the bins of BAND250 followed by those of BAND500, see "band_spectrum()".
+    """
+    columns = {}
+    offset = 0
+    for name, f, (low, high) in zip(['band250', 'band500'], freqs, [BAND250, BAND500]):
+        rms = np.sqrt(power[:, offset:offset + len(f)])
+        offset += len(f)
+
+        # Local maxima like "signal.argrelmax()", filtered like "analyze_peaks()".
+        peak = np.zeros(rms.shape, dtype=bool)
+        peak[:, 1:-1] = (rms[:, 1:-1] > rms[:, :-2]) & (rms[:, 1:-1] > rms[:, 2:])
+        peak &= (rms >= 100) & (f >= low) & (f <= high) & (f <= 1500)
+        candidates = np.where(peak, rms, -np.inf)
+        strongest = np.argmax(candidates, axis=1)
+        found = peak.any(axis=1)
+        columns[name] = np.where(found, candidates[np.arange(len(rms)), strongest], np.nan)
+        columns[name + '_freq'] = np.where(found, f[strongest], np.nan)
+
+    ratio = columns['band500'] / columns['band250']
+    columns['ratio'] = ratio
+    columns['activity'] = np.where(
+        np.isnan(columns['band250']), 'none', np.where(columns['band250'] >= ACTIVITY_THRESHOLD, 'high', 'low'))
+    columns['queenless'] = ratio >= QUEENLESS_RATIO
+    return columns
+
+def window_segments(segments, fs, window=None, hop=None, nperseg=WELCH_NPERSEG):
+    """
+    Map sliding windows of "window" seconds, every "hop" seconds, onto Welch
+    segments overlapping by half. Returns the index of the first segment and
+    the number of segments of each window. Without "window", there is a
+    single window covering all segments.
 
-    plt.xlim((30, 1500))
-    #plt.ylim((10**2, 10**4))
-    #plt.ylim((10**2, 5000000))
-    plt.ylim((0, 2500))
+    Both durations are rounded to whole segment steps, which are 81 ms
+    at 6300 Hz, so window spectra can be assembled from shared segments.
+    """
+    if window is None:
+        return np.array([0]), np.array([segments])
+    step = nperseg - nperseg // 2
+    count = max(int((window * fs - nperseg // 2) // step), 1)
+    begins = np.arange(0, max(segments - count, 0) + 1, max(int(round((hop or window) * fs / step)), 1))
+    return begins, np.minimum(count, segments - begins)
+
+def window_spectra(x, fs, window, hop=None, workers=None, window_function='flattop', nperseg=WELCH_NPERSEG, blocksize=256):
+    """
+    Compute the Welch spectrum of each sliding window of "window" seconds,
+    every "hop" seconds. Returns the frequencies, the first segment and
+    the number of segments of each window, and one spectrum per window.
+
+    Periodograms of all segments are computed block by block as one 2-D
+    FFT, optionally on multiple threads, and summed up per window. So,
+    each segment is only transformed once, even if windows overlap, and
+    memory usage is bounded by the block size and the number of windows.
+    Windows are aligned to segments, see "window_segments()".
+
+    As segments overlap by half, they are assembled from half segments,
+    and detrending is applied to the spectrum, by subtracting the
+    spectrum of the window scaled by the segment mean.
+    """
+    import scipy.fft
+    if x.ndim == 2:
+        x = x[:, 0]
+    half = nperseg // 2
+    segments = max(len(x) // half - 1, 0)
+    win = signal.get_window(window_function, nperseg)
+    response = scipy.fft.rfft(win)
+    f = np.fft.rfftfreq(nperseg, 1.0 / fs)
+
+    begins, counts = window_segments(segments, fs, window, hop, nperseg)
+    ends = begins + counts
+    sums = np.zeros((len(begins), len(f)))
+    for first in range(0, segments, blocksize):
+        count = min(blocksize, segments - first)
+        halves = np.asarray(x[first * half:(first + count + 1) * half], dtype=np.float64).reshape(count + 1, half)
+        block = np.concatenate([halves[:-1] * win[:half], halves[1:] * win[half:]], axis=1)
+        spectrum = scipy.fft.rfft(block, axis=1, workers=workers)
+        totals = halves.sum(axis=1)
+        spectrum -= ((totals[:-1] + totals[1:]) / nperseg)[:, None] * response
+        periodograms = np.abs(spectrum) ** 2
+
+        # Add the segments of this block to all windows they belong to,
+        # summing up the pieces between window boundaries only once.
+        touched = np.flatnonzero((begins < first + count) & (ends > first))
+        low = np.clip(begins[touched] - first, 0, count)
+        high = np.clip(ends[touched] - first, 0, count)
+        cuts = np.union1d(low, high)
+        cuts = cuts[cuts < count]
+        pieces = np.vstack([np.zeros(len(f)), np.cumsum(np.add.reduceat(periodograms, cuts, axis=0), axis=0)])
+        positions = np.append(cuts, count)
+        sums[touched] += pieces[np.searchsorted(positions, high)] - pieces[np.searchsorted(positions, low)]
+
+    # Average, scale to power spectrum and convert to one-sided spectrum.
+    spectra = sums / (np.maximum(counts, 1)[:, None] * win.sum() ** 2)
+    if nperseg % 2:
+        spectra[:, 1:] *= 2
+    else:
+        spectra[:, 1:-1] *= 2
 
-    plt.xticks(range(0, 1501, 100))
+    return f, begins, counts, spectra
 
-    plt.xlabel('frequency [Hz]')
-    plt.ylabel('Linear spectrum [V RMS]')
+def windowed_power(x, fs, window, hop=None, workers=None, window_function='flattop', nperseg=WELCH_NPERSEG, blocksize=256):
+    """
+    Time-resolved variant of "power_spectrum()": Compute the Welch spectrum
+    of each sliding window, see "window_spectra()", and derive peaks and
+    verdicts from each of them.
+    """
+    half = nperseg // 2
+    f, begins, counts, spectra = window_spectra(
+        x, fs, window, hop=hop, workers=workers, window_function=window_function, nperseg=nperseg, blocksize=blocksize)
+
+    results = []
+    for begin, count, Pxx_spec in zip(begins.tolist(), counts.tolist(), spectra):
+        peak_freq, peak_power = find_peaks(f, Pxx_spec)
+        result = power_data(analyze_peaks(dict(zip(peak_freq, np.sqrt(peak_power)))))
+        result['time_begin'] = begin * half / float(fs)
+        result['time_end'] = (begin * half + (count - 1) * half + nperseg) / float(fs)
+        results.append(result)
+    return results
+
+def band_power(x, fs, window=None, hop=None, nperseg=WELCH_NPERSEG):
+    """
+    Fast path for the activity and queen verdicts of "power_spectrum()", only
+    computing the power within BAND250 and BAND500. Without "window", returns
+    a single result like "analyze_peaks()" for the whole signal. Otherwise,
+    returns one entry per window of "window" seconds, every "hop" seconds.
+
+    Windows are aligned to the segments shared by all windows, see
+    "window_segments()". Within a window, the result is the same as for
+    "power_spectrum()" of that window.
+    """
+    if x.ndim == 2:
+        x = x[:, 0]
+    freqs, power = band_spectrum(x, fs, nperseg=nperseg)
+    step = nperseg // 2
+    cumulative = np.vstack([np.zeros(power.shape[1]), np.cumsum(power, axis=0)])
+
+    begins, counts = window_segments(len(power), fs, window, hop, nperseg)
+    means = (cumulative[begins + counts] - cumulative[begins]) / np.maximum(counts, 1)[:, None]
+    columns = band_verdicts(freqs, means)
+
+    def band(name, index):
+        value = columns[name][index]
+        return None if np.isnan(value) else {'freq': float(columns[name + '_freq'][index]), 'power': float(value)}
+
+    results = []
+    for index, begin in enumerate(begins.tolist()):
+        ratio = columns['ratio'][index]
+        result = {
+            'band250': band('band250', index),
+            'band500': band('band500', index),
+            'ratio': None if np.isnan(ratio) else float(ratio),
+            'activity': str(columns['activity'][index]),
+            'queenless': bool(columns['queenless'][index]),
+        }
+        if window is not None:
+            result['time_begin'] = begin * step / float(fs)
+            result['time_end'] = (begin * step + (counts[index] - 1) * step + nperseg) / float(fs)
+        results.append(result)
+
+    return results[0] if window is None else results
+
+def spectral_embeddings(f, spectra):
+    """
+    Describe power spectra by compact vectors for similarity search, one row
+    per spectrum: The square root of the share of energy within each of
+    EMBEDDING_BANDS, followed by the frequency of the strongest bin overall,
+    within BAND250 and within BAND500, the level at ~250 Hz and the share of
+    ~500 Hz in both bands. All features range from about 0 to 1.
+    """
+    spectra = np.atleast_2d(spectra)
+    rows = np.arange(len(spectra))
+    bands = np.digitize(f, EMBEDDING_BANDS) - 1
+    inside = (bands >= 0) & (bands < len(EMBEDDING_BANDS) - 1)
+    membership = (bands[inside][:, None] == np.arange(len(EMBEDDING_BANDS) - 1)).astype(np.float64)
+    energies = spectra[:, inside] @ membership
+    shares = np.sqrt(energies / np.maximum(energies.sum(axis=1, keepdims=True), np.finfo(np.float64).tiny))
+
+    def strongest(low, high):
+        mask = (f >= low) & (f <= high)
+        index = np.argmax(spectra[:, mask], axis=1)
+        return f[mask][index], np.sqrt(spectra[:, mask][rows, index])
+
+    peak_freq, _ = strongest(*BANDPASS)
+    freq250, rms250 = strongest(*BAND250)
+    freq500, rms500 = strongest(*BAND500)
+    return np.column_stack([
+        shares,
+        peak_freq / BANDPASS[1],
+        (freq250 - BAND250[0]) / (BAND250[1] - BAND250[0]),
+        (freq500 - BAND500[0]) / (BAND500[1] - BAND500[0]),
+        np.log10(1 + rms250) / np.log10(1 + ACTIVITY_THRESHOLD) / 2,
+        rms500 / np.maximum(rms250 + rms500, np.finfo(np.float64).tiny),
+    ]).astype(np.float32)
+
+@profiled('embed_recording')
+def embed_recording(x, fs, window=EMBEDDING_WINDOW, workers=None):
+    """
+    Compute the spectral embeddings of consecutive windows of a recording,
+    with samples on the scale of 16-bit PCM like "power_spectrum()".
 
-    # Plot power spectrum
-    #plt.semilogy(f, np.sqrt(Pxx_spec), 'b')
-    plt.plot(f, np.sqrt(Pxx_spec), 'b')
+    Returns the offset of each window in seconds, the window embeddings
+    and their mean, which is the embedding of the whole recording.
+    """
+    f, begins, counts, spectra = window_spectra(x, fs, window, workers=workers, nperseg=WELCH_NPERSEG)
+    vectors = spectral_embeddings(f, spectra)
+    return begins * (WELCH_NPERSEG // 2) / float(fs), vectors, vectors.mean(axis=0)
 
-    # Plot peak points as dots
-    #plt.semilogy(peak_freq, np.sqrt(peak_power), 'ro')
-    plt.plot(peak_freq, np.sqrt(peak_power), 'ro')
+def print_power_timeline(results):
+    """
+    Render the verdicts of "band_power()" or "windowed_power()" for sliding windows as a table.
+    """
+    print('================')
+    print('Power by windows')
+    print('================')
+    for entry in results:
+        print('{begin:9.1f}s - {end:9.1f}s   {power:10.2f} RMS   ratio {ratio:>5}   {activity:5} activity{queenless}'.format(
+            begin=entry['time_begin'], end=entry['time_end'],
+            power=entry['band250']['power'] if entry['band250'] else 0,
+            ratio='{:.2f}'.format(entry['ratio']) if entry['ratio'] is not None else '-',
+            activity=entry['activity'], queenless=', queenless' if entry['queenless'] else ''))
+    print()
 
+def power_spectrum(wavfile=None, samplerate=None, samples=None, png=True, report=True):
+    """
+    Compute power spectrum, print peak report and render image.
+
+    Returns the name of the .png file, if any, and the result of "analyze_peaks()".
+    """
+
+    f, Pxx_spec = compute_power_spectrum(wavfile=wavfile, samplerate=samplerate, samples=samples)
+    peak_freq, peak_power = find_peaks(f, Pxx_spec)
 
     # Aggregate dictionary of peak frequencies mapping to their power
     peak_data = dict(zip(peak_freq, np.sqrt(peak_power)))
 
     # Print peak report.
-    if peak_data:
-        power_spectrum_report(peak_data)
-    else:
+    if not peak_data:
         print("WARNING: Unable to compute peak data")
+    if peak_data and report:
+        analysis = power_spectrum_report(peak_data)
+    else:
+        analysis = analyze_peaks(peak_data)
+
+    pngfile = None
+    if png:
+        with MATPLOTLIB_LOCK:
+            pngfile = render_power_spectrum(f, Pxx_spec, peak_freq, peak_power)
+
+    return pngfile, analysis
+
+@profiled('render_power_spectrum')
+def render_power_spectrum(f, Pxx_spec, peak_freq, peak_power):
+    fig = figure()
+    ax = fig.add_subplot()
+
+    # Plot power spectrum and peaks
+    ax.set_xlim((30, 1500))
+    ax.set_ylim((0, 2500))
+
+    ax.set_xticks(range(0, 1501, 100))
+    ax.tick_params(axis='x', labelsize=10)
+
+    ax.set_xlabel('frequency [Hz]')
+    ax.set_ylabel('Linear spectrum [V RMS]')
+
+    # Plot power spectrum
+    ax.plot(f, np.sqrt(Pxx_spec), 'b')
+
+    # Plot peak points as dots
+    ax.plot(peak_freq, np.sqrt(peak_power), 'ro')
 
     tmpfile = NamedTemporaryFile(suffix='.png', delete=False)
-    plt.savefig(tmpfile.name)
-    #plt.show()
+    fig.savefig(tmpfile.name)
 
     return tmpfile.name
 
-
-def power_spectrum_report(peak_data):
+def analyze_peaks(peak_data):
+    """
+    Derive the activity and queen verdicts from a dictionary
+    of peak frequencies mapping to their power (RMS).
+    """
 
     # Filter <= 1500 Hz and RMS >= 100
     peak_data = {freq: power for freq, power in peak_data.items() if freq <= 1500 and power >= 100}
 
+    result = {
+        'peaks': peak_data,
+        'band250': None,
+        'band500': None,
+        'ratio': None,
+        'activity': 'none',
+        'queenless': False,
+    }
+
+    # Find strongest peak at ~500Hz and ~250Hz
+    #i1: 445-525 / 220-275
+    for name, (low, high) in [('band500', BAND500), ('band250', BAND250)]:
+        band = {freq: power for freq, power in peak_data.items() if low <= freq <= high}
+        if band:
+            freq = max(band, key=peak_data.get)
+            result[name] = {'freq': freq, 'power': peak_data[freq]}
+
+    if result['band250']:
+        result['activity'] = 'high' if result['band250']['power'] >= ACTIVITY_THRESHOLD else 'low'
+
+    # Compute ratio between energy at ~500Hz and ~250Hz
+    if result['band500'] and result['band250']:
+        result['ratio'] = float(result['band500']['power']) / float(result['band250']['power'])
+        result['queenless'] = result['ratio'] >= QUEENLESS_RATIO
+
+    return result
+
+def power_data(analysis):
+    """
+    Convert the result of "analyze_peaks()" for JSON serialization.
+    """
+    def band(entry):
+        return entry and {'freq': float(entry['freq']), 'power': float(entry['power'])}
+    return {
+        'peaks': [{'freq': float(freq), 'power': float(power)} for freq, power in sorted(analysis['peaks'].items())],
+        'band250': band(analysis['band250']),
+        'band500': band(analysis['band500']),
+        'ratio': analysis['ratio'],
+        'activity': analysis['activity'],
+        'queenless': bool(analysis['queenless']),
+    }
+
+@profiled('power_spectrum_report')
+def power_spectrum_report(peak_data):
+
+    analysis = analyze_peaks(peak_data)
+    peak_data = analysis['peaks']
+
     # Display power spectrum report
     print('==================')
     print('Peaks by frequency')
@@ -408,32 +2226,30 @@ def power_spectrum_report(peak_data):
         print(line)
     print()
 
-    # Compute ratio between energy at ~500Hz and ~250Hz
+    print_verdict(analysis)
+
+    return analysis
+
+def print_verdict(analysis):
+    """
+    Print the activity and queen verdicts of "analyze_peaks()" or "band_power()".
+    """
+
+    # Ratio between energy at ~500Hz and ~250Hz
     print('========')
     print('Analysis')
     print('========')
-    #i1: 445-525 / 220-275
-    band500 = {freq: power for freq, power in peak_data.items() if 445 <= freq <= 525}
-    band250 = {freq: power for freq, power in peak_data.items() if 220 <= freq <= 275}
-    freq500 = None
-    freq250 = None
-    if band500:
-        freq500 = max(band500, key=peak_data.get)
-        power500 = peak_data[freq500]
-    if band250:
-        freq250 = max(band250, key=peak_data.get)
-        power250 = peak_data[freq250]
-
-    if freq250:
-        text250 = 'Frequency at {freq} Hz has a power of {power} RMS'.format(freq=freq250, power=peak_data[freq250])
-        if power250 >= 1000:
+
+    if analysis['band250']:
+        text250 = 'Frequency at {freq} Hz has a power of {power} RMS'.format(**analysis['band250'])
+        if analysis['activity'] == 'high':
             status = color('Colony has high activity.', fg='green', style='bold')
-            reason = 'Reason: {text250}, which is >= 1000 RMS.'.format(text250=text250)
+            reason = 'Reason: {text250}, which is >= {threshold} RMS.'.format(text250=text250, threshold=ACTIVITY_THRESHOLD)
             print(status),
             print(reason)
         else:
             status = color('Colony has low activity.', fg='yellow', style='bold')
-            reason = 'Reason: {text250}, which is < 1000 RMS.'.format(text250=text250)
+            reason = 'Reason: {text250}, which is < {threshold} RMS.'.format(text250=text250, threshold=ACTIVITY_THRESHOLD)
             print(status),
             print(reason)
     else:
@@ -442,28 +2258,1206 @@ def power_spectrum_report(peak_data):
             print(status),
             print(reason)
 
-    if freq500 and freq250:
-        #print(power500, power250)
-        ratio = float(power500) / float(power250)
-        if ratio >= 0.6:
+    if analysis['ratio'] is not None:
+        if analysis['queenless']:
             status = color('Colony probably has no queen.', fg='red', style='bold')
-            reason = 'Reason: Ratio of powers at ~500Hz / ~250Hz is {ratio}, which is >= 0.6.'.format(ratio=ratio)
+            reason = 'Reason: Ratio of powers at ~500Hz / ~250Hz is {ratio}, which is >= {threshold}.'.format(ratio=analysis['ratio'], threshold=QUEENLESS_RATIO)
             print(status),
             print(reason)
 
         print()
 
 
+class ResultCache(object):
+    """
+    Content-addressed on-disk cache for resampled signals, .dat files and states.
+
+    Entries are keyed by the SHA-256 digest of the input file together
+    with the processing parameters. Each access refreshes the modification
+    time of an entry, so the least recently used entries are evicted first
+    when the total size of the cache exceeds "max_size" bytes.
+
+    Scanning the cache is costly, so the total size is tracked by adding up
+    the entries this instance puts, and the cache only gets rescanned when
+    that exceeds "max_size" or every CACHE_SCAN_INTERVAL entries, to account
+    for other processes sharing the cache.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.digests = {}
+        self.size = None
+        self.puts = 0
+
+    def digest(self, filename):
+        stat = os.stat(filename)
+        identity = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if identity not in self.digests:
+            sha = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                    sha.update(chunk)
+            self.digests[identity] = sha.hexdigest()
+        return self.digests[identity]
+
+    def key(self, filename, **params):
+        payload = json.dumps([self.digest(filename), params], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key, suffix):
+        """
+        Return the path to a cache entry, or None if there is none.
+        """
+        path = self.path(key, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, suffix, filename):
+        """
+        Move a file into the cache and return its new path.
+        """
+        path = self.path(key, suffix)
+        tmppath = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(filename, tmppath)
+        os.replace(tmppath, path)
+
+        self.puts += 1
+        if self.size is not None:
+            self.size += os.path.getsize(path)
+        if self.size is None or self.size > self.max_size or self.puts % CACHE_SCAN_INTERVAL == 0:
+            self.evict(protect=path)
+        return path
+
+    def load(self, key):
+        path = self.get(key, '.json')
+        if path:
+            with open(path) as f:
+                return json.load(f)
+
+    def store(self, key, data):
+        tmpfile = NamedTemporaryFile(mode='w', suffix='.json', delete=False)
+        with tmpfile:
+            json.dump(data, tmpfile)
+        self.put(key, '.json', tmpfile.name)
+
+    def load_array(self, key):
+        path = self.get(key, '.npy')
+        if path:
+            return np.load(path, mmap_mode='r')
+
+    def store_array(self, key, data):
+        tmpfile = NamedTemporaryFile(suffix='.npy', delete=False)
+        with tmpfile:
+            np.save(tmpfile, data)
+        self.put(key, '.npy', tmpfile.name)
+
+    def evict(self, protect=None):
+        """
+        Scan the cache and remove the least recently used entries, until its
+        total size is within "max_size". Files of other processes still on
+        their way into the cache, see "put()", are left alone.
+        """
+        entries = []
+        for path, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                filename = os.path.join(path, filename)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            if filename == protect:
+                continue
+            try:
+                os.unlink(filename)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self.size = total
+
+class Archive(object):
+    """
+    Columnar store of analysis results across many hives and days.
+
+    Each table is a file of raw NumPy structured array rows, see
+    ARCHIVE_TABLES, which gets appended to and is read through memory
+    maps. States and hives are stored as small integer codes into the
+    vocabularies kept in "archive.json", which also holds the number of
+    valid rows of each table. It is written last, so rows of an
+    interrupted append are ignored and overwritten by the next one.
+    File names of recordings are kept in "recordings.ndjson".
+
+    Times are seconds since the epoch (UTC). Rows of the "recordings"
+    table carry the band powers and ratio from "analyze_peaks()" or
+    NaN, "windows" holds one row per state, "peaks" the filtered peaks.
+    "embeddings" and "window_embeddings" hold the vectors from
+    "embed_recording()" for recordings and their windows, see "similar()".
+    Running sums of their columns and squared columns are kept in
+    "archive.json" as well, so queries don't need to scan for them.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta = {'hives': [], 'states': [], 'rows': dict.fromkeys(ARCHIVE_TABLES, 0)}
+        metafile = os.path.join(directory, 'archive.json')
+        if os.path.exists(metafile):
+            with open(metafile) as f:
+                self.meta = json.load(f)
+        for name in ARCHIVE_TABLES:
+            self.meta['rows'].setdefault(name, 0)
+        self.meta.setdefault('statistics', {})
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def table(self, name):
+        """
+        Memory-map all valid rows of a table.
+        """
+        rows = self.meta['rows'][name]
+        if not rows:
+            return np.zeros(0, dtype=ARCHIVE_TABLES[name])
+        return np.memmap(self.path(name), dtype=ARCHIVE_TABLES[name], mode='r', shape=(rows,))
+
+    def code(self, vocabulary, value):
+        values = self.meta[vocabulary]
+        if value not in values:
+            values.append(value)
+        return values.index(value)
+
+    def write(self, name, rows):
+        with open(self.path(name), 'ab') as f:
+            f.truncate(self.meta['rows'][name] * ARCHIVE_TABLES[name].itemsize)
+            rows.tofile(f)
+        self.meta['rows'][name] += len(rows)
+
+    def statistics(self, name, vectors=None):
+        """
+        Running column sums and sums of squares of the vectors of an
+        embeddings table, optionally adding "vectors" which are about to
+        be appended. Archives written without them are scanned once.
+        """
+        statistics = self.meta['statistics'].get(name)
+        if statistics is None:
+            table = np.asarray(self.table(name)['vector'], dtype=np.float64)
+            statistics = {'sum': table.sum(axis=0).tolist(), 'sumsq': np.square(table).sum(axis=0).tolist()}
+        if vectors is not None:
+            vectors = np.asarray(vectors, dtype=np.float64).reshape(-1, EMBEDDING_SIZE)
+            statistics = {
+                'sum': (np.add(statistics['sum'], vectors.sum(axis=0))).tolist(),
+                'sumsq': (np.add(statistics['sumsq'], np.square(vectors).sum(axis=0))).tolist()}
+        self.meta['statistics'][name] = statistics
+        return np.array(statistics['sum']), np.array(statistics['sumsq'])
+
+    def append(self, hive, begin, audiofile=None, states=None, analysis=None, duration=None, embeddings=None):
+        """
+        Archive the states and/or the power analysis of a recording
+        starting at "begin", optionally along with its embeddings
+        from "embed_recording()". Returns the number of the recording.
+        """
+        recording = self.meta['rows']['recordings']
+        hive_code = self.code('hives', hive)
+        states = states or []
+        if len(set(self.meta['states']) | set(states)) > 256:
+            raise AudiohealthError('Too many distinct states for archive {}'.format(self.directory))
+
+        windows = np.zeros(len(states), dtype=ARCHIVE_TABLES['windows'])
+        windows['recording'] = recording
+        windows['hive'] = hive_code
+        windows['time'] = begin + np.arange(len(states)) * WINDOW_LENGTH
+        windows['state'] = [self.code('states', state) for state in states]
+
+        row = np.zeros(1, dtype=ARCHIVE_TABLES['recordings'])
+        row['recording'], row['hive'], row['time'] = recording, hive_code, begin
+        row['duration'] = duration if duration is not None else len(states) * WINDOW_LENGTH
+        row['windows'] = len(states)
+        row['band250'] = row['band500'] = row['ratio'] = np.nan
+
+        peaks = np.zeros(0, dtype=ARCHIVE_TABLES['peaks'])
+        if analysis:
+            for name in ['band250', 'band500']:
+                if analysis[name]:
+                    row[name] = analysis[name]['power']
+            if analysis['ratio'] is not None:
+                row['ratio'] = analysis['ratio']
+            peaks = np.zeros(len(analysis['peaks']), dtype=ARCHIVE_TABLES['peaks'])
+            peaks['recording'] = recording
+            peaks['freq'] = list(analysis['peaks'].keys())
+            peaks['power'] = list(analysis['peaks'].values())
+
+        self.write('windows', windows)
+        self.write('peaks', peaks)
+        if embeddings is not None:
+            offsets, vectors, vector = embeddings
+            rows = np.zeros(len(vectors), dtype=ARCHIVE_TABLES['window_embeddings'])
+            rows['recording'], rows['hive'], rows['time'], rows['vector'] = recording, hive_code, begin + offsets, vectors
+            self.statistics('window_embeddings', vectors)
+            self.write('window_embeddings', rows)
+            rows = np.zeros(1, dtype=ARCHIVE_TABLES['embeddings'])
+            rows['recording'], rows['hive'], rows['time'], rows['vector'] = recording, hive_code, begin, vector
+            self.statistics('embeddings', vector)
+            self.write('embeddings', rows)
+        self.write('recordings', row)
+        with open(os.path.join(self.directory, 'recordings.ndjson'), 'a') as f:
+            f.write(json.dumps({'recording': recording, 'hive': hive, 'time': begin, 'audiofile': audiofile}) + '\n')
+
+        metafile = os.path.join(self.directory, 'archive.json')
+        with open(metafile + '.tmp', 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(metafile + '.tmp', metafile)
+        return recording
+
+    def select(self, name, hive=None, begin=None, end=None):
+        """
+        Select rows of the "recordings" or "windows" table by hive and time range.
+        """
+        rows = self.table(name)
+        mask = np.ones(len(rows), dtype=bool)
+        if hive is not None:
+            if hive not in self.meta['hives']:
+                return rows[:0]
+            mask &= rows['hive'] == self.meta['hives'].index(hive)
+        if begin is not None:
+            mask &= rows['time'] >= begin
+        if end is not None:
+            mask &= rows['time'] < end
+        return rows[mask]
+
+    def embedding(self, recording):
+        """
+        Look up the embedding of an archived recording.
+        """
+        rows = self.table('embeddings')
+        rows = rows[rows['recording'] == recording]
+        if not len(rows):
+            raise AudiohealthError('No embedding of recording {} in archive {}'.format(recording, self.directory))
+        return np.array(rows['vector'][-1])
+
+    def similar(self, vector, count=10, hive=None, windows=False, exclude=None):
+        """
+        Find the recordings, or with "windows" the windows of recordings,
+        with embeddings most similar to "vector", by cosine similarity.
+
+        Each feature is standardized by its mean and deviation across the
+        whole archive first, so they weigh the same, and differences between
+        recordings are not drowned by what all recordings have in common.
+        Features which don't vary at all are ignored.
+
+        The mean and deviation come from the running statistics, and the
+        standardization is folded into the weights of the query. So, each
+        query only computes dot products over the memory-mapped embeddings,
+        without a pass for the statistics, a standardized copy of the table
+        or reading any audio.
+        """
+        name = 'window_embeddings' if windows else 'embeddings'
+        rows = self.table(name)
+        mask = np.ones(len(rows), dtype=bool)
+        if hive is not None:
+            if hive not in self.meta['hives']:
+                return []
+            mask &= rows['hive'] == self.meta['hives'].index(hive)
+        if exclude is not None:
+            mask &= rows['recording'] != exclude
+        candidates = np.flatnonzero(mask)
+        if not len(candidates):
+            return []
+
+        # With z = (v - mean) / scale, the cosine similarity of the standardized
+        # vectors z and q is z @ q / |z|, for q of unit length. Expanded, both
+        # terms only need the products of v and v ** 2 with fixed weights.
+        total, squares = self.statistics(name)
+        mean = total / len(rows)
+        scale = np.sqrt(np.maximum(squares / len(rows) - mean ** 2, 0))
+        weights = np.divide(1, scale, out=np.zeros_like(scale), where=scale > 1e-6)
+        query = (np.asarray(vector, dtype=np.float64) - mean) * weights
+        query /= max(np.linalg.norm(query), 1e-12)
+        matrix = np.asarray(rows['vector'], dtype=np.float64)
+        coefficients = np.column_stack([query * weights, mean * weights ** 2])
+        products = matrix @ coefficients
+        numerators = products[:, 0] - mean @ coefficients[:, 0]
+        norms = np.square(matrix) @ weights ** 2 - 2 * products[:, 1] + mean @ coefficients[:, 1]
+        scores = numerators / np.maximum(np.sqrt(np.maximum(norms, 0)), 1e-12)
+
+        count = min(count, len(candidates))
+        top = np.argpartition(-scores[candidates], count - 1)[:count]
+        top = candidates[top]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [{
+            'recording': int(rows['recording'][index]),
+            'hive': self.meta['hives'][rows['hive'][index]],
+            'time': float(rows['time'][index]),
+            'score': float(scores[index]),
+        } for index in top.tolist()]
+
+    def audiofiles(self, recordings):
+        """
+        Look up the file names of the given recordings.
+        """
+        prefixes = tuple('{{"recording": {},'.format(recording) for recording in recordings)
+        audiofiles = {}
+        recordingsfile = os.path.join(self.directory, 'recordings.ndjson')
+        if prefixes and os.path.exists(recordingsfile):
+            with open(recordingsfile) as f:
+                for line in f:
+                    if line.startswith(prefixes):
+                        entry = json.loads(line)
+                        audiofiles[entry['recording']] = entry['audiofile']
+        return audiofiles
+
+    def query(self, hive=None, begin=None, end=None, bucket=None):
+        """
+        Summarize the states and power analyses of a hive within a time range,
+        optionally per bucket of "bucket" seconds, without touching any audio.
+        """
+        windows = self.select('windows', hive=hive, begin=begin, end=end)
+        recordings = self.select('recordings', hive=hive, begin=begin, end=end)
+        labels = self.meta['states']
+
+        def aggregate(codes):
+            totals = np.bincount(codes, minlength=len(labels)) * WINDOW_LENGTH
+            return [{'state': labels[i], 'duration': int(totals[i])}
+                    for i in np.argsort(-totals, kind='stable') if totals[i]]
+
+        def power(rows):
+            ratio = rows['ratio'][~np.isnan(rows['ratio'])]
+            band250 = rows['band250'][~np.isnan(rows['band250'])]
+            return {
+                'recordings': int(len(band250)),
+                'band250': float(band250.mean()) if len(band250) else None,
+                'ratio': float(ratio.mean()) if len(ratio) else None,
+                'high_activity': float((band250 >= ACTIVITY_THRESHOLD).mean()) if len(band250) else None,
+                'queenless': float((ratio >= QUEENLESS_RATIO).mean()) if len(ratio) else None,
+            }
+
+        result = {
+            'hive': hive,
+            'begin': begin,
+            'end': end,
+            'recordings': int(len(recordings)),
+            'windows': int(len(windows)),
+            'aggregated': aggregate(windows['state']),
+            'power': power(recordings),
+        }
+        if bucket:
+            window_buckets = np.floor_divide(windows['time'], bucket).astype(np.int64)
+            recording_buckets = np.floor_divide(recordings['time'], bucket).astype(np.int64)
+            result['summary'] = [{
+                'time_begin': int(index * bucket),
+                'time_end': int((index + 1) * bucket),
+                'aggregated': aggregate(windows['state'][window_buckets == index]),
+                'power': power(recordings[recording_buckets == index]),
+            } for index in np.union1d(window_buckets, recording_buckets).tolist()]
+        return result
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 date or timestamp, assuming UTC if no timezone is given.
+    Returns seconds since the epoch.
+    """
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        raise AudiohealthError('Invalid time "{}", use ISO 8601 like 2021-05-01T12:00'.format(value))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+def parse_duration(value):
+    """
+    Parse a duration like "90", "90s", "5m" or "1h" into seconds.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600}
+    try:
+        if value[-1:] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value)
+    except ValueError:
+        raise AudiohealthError('Invalid duration "{}", use e.g. 60s, 5m or 1h'.format(value))
+
+def format_time(seconds):
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def print_query(result):
+    """
+    Render the result of "Archive.query()" as text.
+    """
+    def power(entry):
+        if entry['ratio'] is None:
+            return ''
+        return 'ratio {ratio:.2f}, queenless {queenless:.0%}'.format(**entry)
+
+    print('=======')
+    print('Archive')
+    print('=======')
+    print('Hive:       {}'.format(result['hive'] or 'all'))
+    print('Range:      {} - {}'.format(
+        format_time(result['begin']) if result['begin'] is not None else 'beginning',
+        format_time(result['end']) if result['end'] is not None else 'end'))
+    print('Recordings: {}, windows: {}'.format(result['recordings'], result['windows']))
+    print()
+
+    print('==============')
+    print('Total duration')
+    print('==============')
+    for entry in result['aggregated']:
+        print('{duration:10}s   {state}'.format(**entry))
+    if result['power']['recordings']:
+        print()
+        print('Power spectrum of {recordings} recordings: band250 {band250:.0f} RMS, high activity {high_activity:.0%}, {text}'.format(
+            text=power(result['power']), **result['power']))
+    print()
+
+    if 'summary' in result:
+        print('=======')
+        print('Summary')
+        print('=======')
+        for entry in result['summary']:
+            totals = ', '.join('{state} ({duration}s)'.format(**item) for item in entry['aggregated'])
+            print('{}   {}   {}'.format(format_time(entry['time_begin']), totals, power(entry['power'])).rstrip())
+        print()
+
+def print_similar(results):
+    """
+    Render the result of "Archive.similar()" as text.
+    """
+    print('==================')
+    print('Similar recordings')
+    print('==================')
+    for entry in results:
+        print('{score:6.3f}   {time}   {hive:12}   #{recording:<6} {audiofile}'.format(
+            time=format_time(entry['time']), **entry).rstrip())
+    print()
+
+def recording_time(audiofile, duration, start=None):
+    """
+    Determine when a recording started: Either given explicitly or derived from
+    the modification time of the file, which is when the recorder finished it.
+    """
+    if start:
+        return parse_time(start)
+    return os.path.getmtime(audiofile) - duration
+
+def signal_params(resampler):
+    """
+    Parameters determining the outcome of downsampling, used for cache keys.
+    """
+    return {'resampler': resampler, 'chain': SIGNAL_CHAIN, 'samplerate': SAMPLERATE}
+
+def prepare_wav(audiofile, cache=None):
+    """
+    Downsample audiofile using sox, going through the cache if given.
+    Returns the name of the .wav file and whether it is a temporary file.
+    """
+    if not cache:
+        return resample(audiofile), True
+    key = cache.key(audiofile, stage='resample', **signal_params('sox'))
+    wavfile = cache.get(key, '.wav')
+    if wavfile is None:
+        wavfile = cache.put(key, '.wav', resample(audiofile))
+    return wavfile, False
+
+def prepare_samples(audiofile, resampler='native', cache=None):
+    """
+    Downsample audiofile into memory, going through the cache if given.
+    Neither resampler writes an intermediate .wav file.
+    """
+    downsample = resample_native if resampler == 'native' else resample_samples
+    if not cache:
+        return downsample(audiofile)
+    key = cache.key(audiofile, stage='resample', **signal_params(resampler))
+    samples = cache.load_array(key)
+    if samples is None:
+        samplerate, samples = downsample(audiofile)
+        cache.store_array(key, samples)
+    return SAMPLERATE, samples
+
+def prepare_dat(audiofile, resampler='sox', transport='text', cache=None):
+    """
+    Downsample audiofile and convert it for consumption by the analyzer,
+    going through the cache if given. Returns the name of the datfile
+    and whether it is a temporary file.
+    """
+    suffix = DAT_SUFFIX[transport]
+    if cache:
+        key = cache.key(audiofile, stage='dat', transport=transport, **signal_params(resampler))
+        datfile = cache.get(key, suffix)
+        if datfile:
+            return datfile, False
+
+    samplerate, samples = prepare_samples(audiofile, resampler=resampler, cache=cache)
+    print("Duration: {}s".format(samples.shape[0] / samplerate))
+    tmpfile = NamedTemporaryFile(suffix=suffix, delete=False)
+    datfile = samples_to_dat(samples, tmpfile.name, transport=transport)
+
+    if cache:
+        return cache.put(key, suffix, datfile), False
+    return datfile, True
+
+def parse_strategies(value):
+    """
+    Parse "--strategy" into a list of strategies. Accepts a
+    single strategy, a comma-separated list of them or "all".
+    """
+    if not value:
+        return [DEFAULT_STRATEGY]
+    if value == 'all':
+        return list(STRATEGIES)
+    strategies = [strategy.strip() for strategy in value.split(',') if strategy.strip()]
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            raise AudiohealthError('Unknown strategy "{}". Use one of {}.'.format(strategy, ', '.join(STRATEGIES)))
+    return strategies
+
+def load_samples(audiofile=None, wavfile=None, resampler='sox', cache=None):
+    """
+    Load the downsampled signal into memory, starting at whatever is given.
+    """
+    if audiofile:
+        samplerate, samples = prepare_samples(audiofile, resampler=resampler, cache=cache)
+        return samples
+    samplerate, samples = read_wav(wavfile)
+    return pcm_to_float32(samples)
+
+def run_analysis(audiofile=None, wavfile=None, datfile=None, analyzer=None, strategy=None,
+                 resampler='sox', transport='text', keep=False, cache=None):
+    """
+    Run the whole pipeline "resample -> wav_to_dat -> analyze" on a single input
+    and return the sequence of states. Depending on what is given, processing
+    starts at the audiofile, the downsampled wavfile or the datfile.
+    When starting at the audiofile, all stages go through the cache if given.
+    """
+    strategy = strategy or DEFAULT_STRATEGY
+    results = run_strategies(
+        audiofile=audiofile, wavfile=wavfile, datfile=datfile, analyzer=analyzer, strategies=[strategy],
+        resampler=resampler, transport=transport, keep=keep, cache=cache)
+    return results[strategy]
+
+def run_strategies(audiofile=None, wavfile=None, datfile=None, analyzer=None, strategies=None,
+                   resampler='sox', transport='text', keep=False, cache=None):
+    """
+    Like "run_analysis()", but for multiple strategies. The signal is prepared
+    only once, then the analyzer runs for all strategies concurrently, each
+    within its own thread. Returns a dictionary mapping strategies to states.
+    """
+    strategies = strategies or [DEFAULT_STRATEGY]
+    results = {}
+
+    keys = {}
+    if audiofile and cache:
+        for strategy in strategies:
+            keys[strategy] = cache.key(
+                audiofile, stage='states', strategy=strategy,
+                analyzer=os.path.abspath(analyzer), **signal_params(resampler))
+            states = cache.load(keys[strategy])
+            if states is not None:
+                results[strategy] = states
+
+    pending = [strategy for strategy in strategies if strategy not in results]
+    if not pending:
+        return {strategy: results[strategy] for strategy in strategies}
+
+    # With the "binary" transport, samples are piped to the analyzer
+    # from memory, unless the .f32 file should be kept.
+    transport = analyzer_transport(analyzer, transport)
+    temporary = False
+    if transport == 'binary' and not datfile and not keep:
+        samples = load_samples(audiofile=audiofile, wavfile=wavfile, resampler=resampler, cache=cache)
+        print("Duration: {}s".format(samples.shape[0] / SAMPLERATE))
+        run_strategy = functools.partial(analyze_samples, samples, transport=transport)
+
+    else:
+        # Only delete datfile if not directly specified on command line
+        if audiofile:
+            datfile, temporary = prepare_dat(audiofile, resampler=resampler, transport=transport, cache=cache)
+
+        elif wavfile:
+            datfile = wav_to_dat(wavfile, transport=transport)
+            temporary = True
+
+        run_strategy = functools.partial(analyze, datfile)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = {
+                strategy: executor.submit(run_strategy, analyzer=analyzer, strategy=strategy)
+                for strategy in pending}
+            for strategy in pending:
+                results[strategy] = futures[strategy].result()
+                if strategy in keys:
+                    cache.store(keys[strategy], results[strategy])
+
+    finally:
+        # Cleanup
+        if temporary and not keep:
+            os.unlink(datfile)
+
+    return {strategy: results[strategy] for strategy in strategies}
+
+@profiled('all')
+def analyze_all(audiofile, outdir, analyzer=None, strategy=None, transport='text', max_frames=None):
+    """
+    Produce the whole bundle of results for audiofile in a single run: The
+    states, the power spectrum analysis and the images of the spectrogram
+    and the power spectrum, written to outdir.
+
+    The audio is decoded only once, and each block feeds both the spectrogram
+    and the native resampler, see "resample_blocks()", so only the downsampled
+    signal is held in memory. Then, the classifier, the power spectrum
+    analysis and the rendering of the spectrogram run concurrently on it.
+
+    Returns the states, the result of "analyze_peaks()" and the names of
+    the spectrogram and power spectrum images.
+    """
+    strategy = strategy or DEFAULT_STRATEGY
+    with PROFILER.stage('decode'):
+        with AudioDecoder(audiofile) as decoder:
+            builder = SpectrogramBuilder(decoder.samplerate, decoder.frames, max_frames=max_frames)
+
+            def blocks():
+                for block in decoder:
+                    builder(block)
+                    yield remix(block)
+            samplerate, samples = resample_blocks(blocks(), decoder.samplerate, size=decoder.frames)
+        specgram, time_step, native_samplerate = builder.finish()
+
+    name = os.path.join(outdir, os.path.basename(audiofile))
+    spectrogram_png, power_png = name + '.spectrogram.png', name + '.power.png'
+
+    def classify():
+        return analyze_samples(samples, analyzer=analyzer, strategy=strategy, transport=transport)
+
+    def power():
+        tmpfile, analysis = power_spectrum(samplerate=samplerate, samples=samples * (2.0 ** 15), report=False)
+        shutil.move(tmpfile, power_png)
+        return analysis
+
+    def render():
+        with MATPLOTLIB_LOCK:
+            tmpfile = render_spectrogram(specgram, time_step, native_samplerate, title=os.path.basename(audiofile))
+        shutil.move(tmpfile, spectrogram_png)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(stage) for stage in [classify, power, render]]
+        states, analysis, _ = [future.result() for future in futures]
+
+    return states, analysis, spectrogram_png, power_png
+
+def expand_inputs(inputs):
+    """
+    Expand directories and glob patterns into the list of audio files to process.
+    """
+    audiofiles = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for path, dirnames, filenames in sorted(os.walk(item)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in AUDIO_EXTENSIONS:
+                        audiofiles.append(os.path.join(path, filename))
+        elif glob.has_magic(item):
+            audiofiles += sorted(glob.glob(item, recursive=True))
+        else:
+            audiofiles.append(item)
+    return audiofiles
+
+def report_names(audiofiles):
+    """
+    Name the reports of a batch run after the audio files, relative to the
+    directory they have in common. So, files of the same name from different
+    directories, like "hive-1/2021-05-01.wav" and "hive-2/2021-05-01.wav",
+    don't overwrite each other's reports.
+    """
+    paths = [os.path.abspath(audiofile) for audiofile in audiofiles]
+    if not paths:
+        return {}
+    common = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return {audiofile: os.path.relpath(path, common) + '.txt' for audiofile, path in zip(audiofiles, paths)}
+
+def batch_worker(audiofile, profile=False, **kwargs):
+    """
+    Process a single file of a batch run within a worker process.
+    Any output is captured, errors are reported instead of raised.
+    """
+    result = {'audiofile': audiofile, 'states': None, 'output': None, 'error': None, 'profile': None}
+    if profile:
+        PROFILER.enable()
+        PROFILER.reset()
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            result['states'] = run_analysis(audiofile=audiofile, **kwargs)
+            report(result['states'])
+    except AudiohealthError as ex:
+        result['error'] = str(ex)
+    except Exception as ex:
+        result['error'] = '{}: {}'.format(ex.__class__.__name__, ex)
+    result['output'] = output.getvalue()
+    if profile:
+        result['profile'] = PROFILER.reset()
+    return result
+
+def batch(audiofiles, workers=None, **kwargs):
+    """
+    Run the pipeline for many files on a pool of worker processes.
+    Results are yielded in order of completion.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(batch_worker, audiofile, **kwargs) for audiofile in audiofiles]
+        for future in as_completed(futures):
+            yield future.result()
+
+class PipelineScheduler(object):
+    """
+    Run "resample -> samples_to_dat -> analyze" for many files within a single
+    event loop, see "audiohealth batch --pipeline". Each tool has its own limit
+    of concurrent processes, so sox keeps downsampling the next files while the
+    analyzer works on earlier ones, and both stay busy. At most "sox_jobs" plus
+    "analyzer_jobs" files are in flight, which bounds the memory held by
+    downsampled signals waiting for the analyzer.
+
+    Results have the same form as those of "batch_worker()".
+    """
+
+    def __init__(self, analyzer=None, strategy=None, resampler='sox', transport='text', cache=None,
+                 sox_jobs=None, analyzer_jobs=None, timeout=None):
+        self.analyzer = analyzer
+        self.strategy = strategy or DEFAULT_STRATEGY
+        self.resampler = resampler
+        self.transport = transport
+        self.cache = cache
+        self.sox_jobs = sox_jobs or os.cpu_count() or 1
+        self.analyzer_jobs = analyzer_jobs or os.cpu_count() or 1
+        self.timeout = timeout
+
+    async def run(self, audiofiles):
+        """
+        Process all files, yielding results in order of completion.
+        Pending work is cancelled when the caller stops early.
+        """
+        import asyncio
+        self.limits = {'sox': asyncio.Semaphore(self.sox_jobs), 'osbh-audioanalyzer': asyncio.Semaphore(self.analyzer_jobs)}
+        self.admission = asyncio.Semaphore(self.sox_jobs + self.analyzer_jobs)
+        self.transport = await asyncio.get_running_loop().run_in_executor(
+            None, analyzer_transport, self.analyzer, self.transport)
+        tasks = [asyncio.ensure_future(self.process(audiofile)) for audiofile in audiofiles]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def process(self, audiofile):
+        result = {'audiofile': audiofile, 'states': None, 'output': '', 'error': None, 'profile': None}
+        async with self.admission:
+            try:
+                result['states'] = await self.analyze(audiofile)
+                output = io.StringIO()
+                with redirect_stdout(output):
+                    report(result['states'])
+                result['output'] = output.getvalue()
+            except AudiohealthError as ex:
+                result['error'] = str(ex)
+            except Exception as ex:
+                result['error'] = '{}: {}'.format(ex.__class__.__name__, ex)
+        return result
+
+    async def analyze(self, audiofile):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        key = None
+        if self.cache:
+            # Hashing the audiofile and reading the cache entry block, so
+            # both run on a thread instead of stalling the event loop.
+            params = dict(signal_params(self.resampler), analyzer=os.path.abspath(self.analyzer))
+            key = await loop.run_in_executor(None, functools.partial(
+                self.cache.key, audiofile, stage='states', strategy=self.strategy, **params))
+            states = await loop.run_in_executor(None, self.cache.load, key)
+            if states is not None:
+                return states
+
+        # The native resampler runs on a thread, within the same limit as sox.
+        async with self.limits['sox']:
+            if self.resampler == 'native':
+                samplerate, samples = await loop.run_in_executor(None, resample_native, audiofile)
+            else:
+                samplerate, samples = await resample_async(audiofile, timeout=self.timeout)
+
+        if self.transport == 'binary':
+            async with self.limits['osbh-audioanalyzer']:
+                states = await analyze_async(
+                    samples=samples, analyzer=self.analyzer, strategy=self.strategy, timeout=self.timeout)
+        else:
+            tmpfile = NamedTemporaryFile(suffix=DAT_SUFFIX['text'], delete=False)
+            tmpfile.close()
+            try:
+                await loop.run_in_executor(None, samples_to_dat, samples, tmpfile.name)
+                del samples
+                async with self.limits['osbh-audioanalyzer']:
+                    states = await analyze_async(
+                        tmpfile.name, analyzer=self.analyzer, strategy=self.strategy, timeout=self.timeout)
+            finally:
+                os.unlink(tmpfile.name)
+
+        if key:
+            await loop.run_in_executor(None, self.cache.store, key, states)
+        return states
+
+def pipeline_batch(audiofiles, **kwargs):
+    """
+    Like "batch()", but using the "PipelineScheduler" on an event loop
+    of its own. Results are yielded in order of completion.
+    """
+    import asyncio
+    loop = asyncio.new_event_loop()
+    results = PipelineScheduler(**kwargs).run(audiofiles)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
+
+def batch_record(result):
+    """
+    Structured record of the result of a batch run for one file.
+    """
+    record = {'audiofile': result['audiofile'], 'status': 'failed' if result['error'] else 'ok', 'error': result['error']}
+    if not result['error']:
+        record.update(report_data(result['states']))
+    return record
+
+def batch_summary(result):
+    """
+    Render a single line summarizing the result of a batch run for one file.
+    """
+    if result['error']:
+        reason = result['error'].strip().split('\n')[0]
+        return 'FAILED  {audiofile}: {reason}'.format(audiofile=result['audiofile'], reason=reason)
+
+    chronology, aggregated_sorted = timeline(result['states'])
+    states = ', '.join('{state} ({duration}s)'.format(state=state, duration=duration) for state, duration in aggregated_sorted[:2])
+    return 'OK      {audiofile}: {states}'.format(audiofile=result['audiofile'], states=states or 'no states')
+
+# Commands of "audiohealth serve", each available as "POST /<command>".
+SERVE_COMMANDS = ['analyze', 'power', 'spectrogram', 'all']
+SERVE_MAX_UPLOAD = 1024 ** 3
+HTTP_REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+    413: 'Payload Too Large', 422: 'Unprocessable Entity', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+def serve_warmup():
+    """
+    Load everything a worker process of "audiohealth serve" needs up front,
+    so the first request does not pay for it. Returns the process id.
+    """
+    figure()
+    colormap('inferno')
+    return os.getpid()
+
+def serve_png(pngfile):
+    """
+    Read and remove a temporary .png file, encoded for JSON.
+    """
+    import base64
+    with open(pngfile, 'rb') as f:
+        data = f.read()
+    os.unlink(pngfile)
+    return base64.b64encode(data).decode('ascii')
+
+def serve_job(command, audiofile, params):
+    """
+    Run a single request of "audiohealth serve" within a worker process.
+    Any output is captured, errors are reported instead of raised.
+
+    Returns the HTTP status, the content type and the body of the response.
+    """
+    record = {'command': command, 'filename': params.get('filename')}
+    try:
+        png = params.get('png') in ('1', 'true', 'yes')
+        try:
+            limit = params.get('max_entries') and int(params['max_entries'])
+            max_frames = params.get('max_frames') and int(params['max_frames'])
+        except ValueError as ex:
+            raise AudiohealthError('Invalid parameter: {}'.format(ex))
+        bucket = params.get('summary') and BUCKETS.get(params['summary'])
+        strategy = params.get('strategy') or DEFAULT_STRATEGY
+        kwargs = {key: params[key] for key in ['analyzer', 'transport']}
+
+        with redirect_stdout(io.StringIO()):
+            if command in ('analyze', 'all'):
+                if not params['analyzer']:
+                    raise AudiohealthError('The server has no analyzer configured, see "--analyzer"')
+                if strategy not in STRATEGIES:
+                    raise AudiohealthError('Unknown strategy "{}"'.format(strategy))
+
+            if command == 'analyze':
+                states = run_analysis(audiofile=audiofile, strategy=strategy, resampler=params['resampler'], **kwargs)
+                record['strategy'] = strategy
+                record.update(report_data(states, limit=limit, bucket=bucket))
+
+            elif command == 'power':
+                samplerate, samples = prepare_samples(audiofile, resampler=params['resampler'])
+                if params.get('fast') in ('1', 'true', 'yes'):
+                    record.update(band_power(samples * (2.0 ** 15), samplerate))
+                else:
+                    pngfile, analysis = power_spectrum(
+                        samplerate=samplerate, samples=samples * (2.0 ** 15), png=png, report=False)
+                    record.update(power_data(analysis))
+                    if pngfile:
+                        record['png'] = serve_png(pngfile)
+
+            elif command == 'spectrogram':
+                pngfile = spectrogram(audiofile, max_frames=max_frames)
+                with open(pngfile, 'rb') as f:
+                    data = f.read()
+                os.unlink(pngfile)
+                return 200, 'image/png', data
+
+            elif command == 'all':
+                outdir = mkdtemp()
+                try:
+                    states, analysis, spectrogram_png, power_png = analyze_all(
+                        audiofile, outdir, strategy=strategy, max_frames=max_frames, **kwargs)
+                    record['strategy'] = strategy
+                    record.update(report_data(states, limit=limit, bucket=bucket))
+                    record.update(power_data(analysis))
+                    if png:
+                        record['spectrogram_png'] = serve_png(spectrogram_png)
+                        record['png'] = serve_png(power_png)
+                finally:
+                    shutil.rmtree(outdir)
+
+        status = 200
+    except AudiohealthError as ex:
+        status, record['error'] = 422, str(ex)
+    except Exception as ex:
+        status, record['error'] = 500, '{}: {}'.format(ex.__class__.__name__, ex)
+
+    return status, 'application/json', json.dumps(record, indent=2).encode('utf-8') + b'\n'
+
+class AnalysisServer(object):
+    """
+    Local HTTP API of "audiohealth serve".
+
+    Uploads are taken as raw request bodies, like
+    "curl --data-binary @recording.mp3 'http://localhost:8000/analyze?filename=recording.mp3'",
+    and queued for a pool of worker processes, which are started and warmed
+    up before accepting connections. When the queue is full, requests are
+    rejected right away with "503 Service Unavailable", so callers back off
+    instead of piling up uploads.
+    """
+
+    def __init__(self, workers=None, queue_size=8, **params):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.params = params
+        self.executor = None
+        self.queue = None
+        self.busy = 0
+
+    async def start(self, host='127.0.0.1', port=8000):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        pids = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, serve_warmup)
+            for i in range(self.workers)])
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.dispatchers = [asyncio.ensure_future(self.dispatch()) for i in range(self.workers)]
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        sys.stderr.write('Serving on http://{}:{}/ with {} worker processes ({} warm)\n'.format(
+            host, self.port, self.workers, len(set(pids))))
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for dispatcher in self.dispatchers:
+            dispatcher.cancel()
+        self.executor.shutdown(wait=True)
+
+    async def dispatch(self):
+        """
+        Hand queued jobs over to the worker processes, one at a time.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            self.busy += 1
+            try:
+                result = await loop.run_in_executor(self.executor, serve_job, *job['args'])
+                if not job['future'].done():
+                    job['future'].set_result(result)
+            except Exception as ex:
+                if not job['future'].done():
+                    job['future'].set_exception(ex)
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+
+    async def handle(self, reader, writer):
+        import asyncio
+        import urllib.parse
+        start = time.perf_counter()
+        method, path, status = None, None, 500
+        upload = {'length': 0, 'received': 0}
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if headers.get('content-length', '').isdigit():
+                upload['length'] = int(headers['content-length'])
+            if len(request_line) != 3:
+                status, content_type, body = self.error(400, 'Malformed request line')
+            else:
+                method, target = request_line[:2]
+                url = urllib.parse.urlsplit(target)
+                path = url.path
+                query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+                status, content_type, body = await self.route(method, path, query, headers, reader, writer, upload)
+        except Exception as ex:
+            status, content_type, body = self.error(500, '{}: {}'.format(ex.__class__.__name__, ex))
+
+        head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n'.format(
+            status, HTTP_REASONS.get(status, ''), content_type, len(body))
+        if status == 503:
+            head += 'Retry-After: 1\r\n'
+        try:
+            writer.write(head.encode('latin-1') + b'\r\n' + body)
+            await writer.drain()
+            # Discard the rest of uploads rejected early, so the client
+            # gets to read the response instead of a reset connection.
+            remaining = upload['length'] - upload['received']
+            if 0 < remaining <= SERVE_MAX_UPLOAD:
+                await asyncio.wait_for(self.discard(reader, remaining), timeout=60)
+            writer.close()
+        except (ConnectionError, asyncio.TimeoutError):
+            writer.close()
+        sys.stderr.write('{} {} {} {:.3f}s\n'.format(method, path, status, time.perf_counter() - start))
+
+    async def discard(self, reader, remaining):
+        while remaining:
+            chunk = await reader.read(min(remaining, 2 ** 20))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+    def error(self, status, message):
+        return status, 'application/json', json.dumps({'error': message}).encode('utf-8') + b'\n'
+
+    async def route(self, method, path, query, headers, reader, writer, upload):
+        import asyncio
+        command = path.strip('/')
+        if command == 'health':
+            if method != 'GET':
+                return self.error(405, 'Use GET')
+            body = {'status': 'ok', 'version': VERSION, 'workers': self.workers, 'busy': self.busy,
+                    'queued': self.queue.qsize(), 'queue_size': self.queue_size}
+            return 200, 'application/json', json.dumps(body).encode('utf-8') + b'\n'
+        if command not in SERVE_COMMANDS:
+            return self.error(404, 'Unknown command "{}". Use one of {}.'.format(command, ', '.join(SERVE_COMMANDS)))
+        if method != 'POST':
+            return self.error(405, 'Use POST to upload audio')
+        if not headers.get('content-length', '').isdigit():
+            return self.error(411, 'Uploads need a Content-Length')
+        length = upload['length']
+        if length > SERVE_MAX_UPLOAD:
+            return self.error(413, 'Uploads are limited to {} bytes'.format(SERVE_MAX_UPLOAD))
+        if self.queue.full():
+            return self.error(503, 'Too many pending requests, try again later')
+
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await writer.drain()
+
+        # The suffix tells the decoder about the format of the upload.
+        suffix = os.path.splitext(os.path.basename(query.get('filename', '')))[1] or '.wav'
+        audiofile = NamedTemporaryFile(suffix=suffix, delete=False)
+        try:
+            with audiofile:
+                while upload['received'] < length:
+                    chunk = await reader.read(min(length - upload['received'], 2 ** 20))
+                    if not chunk:
+                        return self.error(400, 'Upload ended prematurely')
+                    audiofile.write(chunk)
+                    upload['received'] += len(chunk)
+
+            params = dict(self.params, **{key: value for key, value in query.items() if key not in self.params})
+            future = asyncio.get_running_loop().create_future()
+            try:
+                self.queue.put_nowait({'args': (command, audiofile.name, params), 'future': future})
+            except asyncio.QueueFull:
+                return self.error(503, 'Too many pending requests, try again later')
+            return await future
+        finally:
+            os.unlink(audiofile.name)
+
+def serve(host='127.0.0.1', port=8000, workers=None, queue_size=8, **params):
+    """
+    Run "audiohealth serve" until interrupted or terminated,
+    then shut down the worker processes.
+    """
+    import asyncio
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in [SIGINT, SIGTERM]:
+            loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+        server = await AnalysisServer(workers=workers, queue_size=queue_size, **params).start(host, port)
+        try:
+            await stop
+        finally:
+            await server.close()
+
+    asyncio.run(main())
+
+
 def main():
     """
     Usage:
-      audiohealth analyze --audiofile audiofile --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--debug] [--keep]
-      audiohealth analyze --wavfile wavfile --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--debug]
-      audiohealth analyze --datfile datfile --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--debug]
-      audiohealth convert --audiofile audiofile --wavfile wavfile
-      audiohealth spectrogram --audiofile audiofile --pngfile pngfile
-      audiohealth power   --audiofile audiofile --pngfile pngfile
-      audiohealth power   --wavfile wavfile     --pngfile pngfile
+      audiohealth analyze --audiofile audiofile --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--resampler sox] [--transport text] [--format text] [--summary hour] [--max-entries 100] [--cache-dir cachedir | --no-cache] [--archive archivedir] [--hive hive] [--start time] [--profile] [--debug] [--keep]
+      audiohealth analyze --audiofile audiofile --analyzer /path/to/osbh-audioanalyzer --resume [--checkpoint checkpointfile] [--strategy lr-2.1] [--transport text] [--format text] [--summary hour] [--max-entries 100] [--archive archivedir] [--hive hive] [--start time] [--profile] [--debug]
+      audiohealth analyze --wavfile wavfile --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--transport text] [--format text] [--summary hour] [--max-entries 100] [--archive archivedir] [--hive hive] [--start time] [--profile] [--debug]
+      audiohealth analyze --datfile datfile --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--format text] [--summary hour] [--max-entries 100] [--archive archivedir] [--hive hive] [--start time] [--profile] [--debug]
+      audiohealth batch <input>... --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--resampler sox] [--transport text] [--workers 4] [--pipeline] [--sox-jobs 2] [--timeout 600] [--outdir outdir] [--format text] [--cache-dir cachedir | --no-cache] [--archive archivedir] [--hive hive] [--profile] [--prometheus promfile] [--debug]
+      audiohealth stream --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--samplerate 44100] [--channels 1] [--transport text] [--format text] [--profile] [--prometheus promfile] [--debug]
+      audiohealth convert --audiofile audiofile --wavfile wavfile [--resampler sox] [--cache-dir cachedir | --no-cache]
+      audiohealth spectrogram --audiofile audiofile --pngfile pngfile [--max-frames 2000] [--profile]
+      audiohealth all --audiofile audiofile --outdir outdir --analyzer /path/to/osbh-audioanalyzer [--strategy lr-2.1] [--transport text] [--max-frames 2000] [--format text] [--summary hour] [--max-entries 100] [--profile]
+      audiohealth power   --audiofile audiofile (--pngfile pngfile | --no-png) [--resampler sox] [--fast] [--window 60s] [--hop 30s] [--workers 4] [--format text] [--cache-dir cachedir | --no-cache] [--archive archivedir] [--hive hive] [--start time] [--profile]
+      audiohealth power   --wavfile wavfile     (--pngfile pngfile | --no-png) [--fast] [--window 60s] [--hop 30s] [--workers 4] [--format text] [--archive archivedir] [--hive hive] [--start time] [--profile]
+      audiohealth serve [--analyzer /path/to/osbh-audioanalyzer] [--resampler sox] [--transport text] [--host 127.0.0.1] [--port 8000] [--workers 4] [--queue-size 8] [--debug]
+      audiohealth query --archive archivedir [--hive hive] [--from time] [--until time] [--summary day] [--format text]
+      audiohealth similar --archive archivedir (--audiofile audiofile | --recording number) [--hive hive] [--count 10] [--by-window] [--resampler sox] [--format text]
       audiohealth --version
       audiohealth (-h | --help)
 
@@ -471,10 +3465,48 @@ def main():
       --wavfile=<wavfile>       Name of .wav file
       --pngfile=<pngfile>       Output .png file of power spectrum
       --audiofile=<audiofile>   Process audiofile. Please use sox-compatible input formats.
-      --datfile=<datfile>       Process datfile.
+      --datfile=<datfile>       Process datfile. Files ending with .f32 are read as binary.
       --analyzer=<analyzer>     Path to OSBH audioanalyzer binary
-      --strategy=<strategy>     The classification strategy. One of dt-0.9, dt-1.0, dt-2.0, lr-2.0, lr-2.1
-      --keep                    Keep (don't delete) downsampled and .dat file
+      --strategy=<strategy>     The classification strategy. One of dt-0.9, dt-1.0, dt-2.0, lr-2.0, lr-2.1.
+                                Use a comma-separated list or "all" to compare multiple strategies.
+      --resampler=<resampler>   How to downsample the audiofile. One of sox, native. "all" always resamples natively, while decoding [default: sox]
+      --transport=<transport>   How to hand over samples to the analyzer. One of text, binary. No published analyzer build reads binary yet, it falls back to text then [default: text]
+      --format=<format>         Output format. One of text, json, ndjson [default: text]
+      --resume                  Only analyze audio appended to a growing .wav file since the last run
+      --checkpoint=<checkpointfile>  Where to keep the state for "--resume". Defaults to <audiofile>.checkpoint.npz.
+      --archive=<archivedir>    Append results to this archive, or query it
+      --hive=<hive>             Name of the hive the recordings are from
+      --start=<time>            When the recording started, like 2021-05-01T12:00 (UTC).
+                                Defaults to the modification time of the file, minus its duration.
+      --from=<time>             Query results from this time on (UTC)
+      --until=<time>            Query results before this time (UTC)
+      --recording=<number>      Find recordings similar to this archived recording
+      --count=<count>           How many similar recordings to find [default: 10]
+      --by-window               Find similar windows of recordings instead of whole recordings
+      --summary=<bucket>        Also summarize states per hour or per day
+      --max-entries=<count>     List at most this many states and segments in reports
+      --no-png                  Only compute and report, don't render an image
+      --fast                    Only compute the power within the bands at ~250 Hz and ~500 Hz, without image
+      --window=<duration>       Analyze the power spectrum within sliding windows of this duration, like 60s, 5m or 1h
+      --hop=<duration>          Distance between sliding windows. Defaults to the window duration.
+      --max-frames=<frames>     Average spectrogram frames into at most this many time bins
+      --samplerate=<rate>       Samplerate of raw PCM input on stdin [default: 44100]
+      --channels=<channels>     Number of channels of raw PCM input on stdin [default: 1]
+      --workers=<workers>       Number of worker processes for batch mode and the server, or threads for
+                                computing spectra of windows. Defaults to the number of CPUs, or one thread.
+      --host=<host>             Address to listen on [default: 127.0.0.1]
+      --port=<port>             Port to listen on [default: 8000]
+      --queue-size=<size>       How many requests may wait for a worker, before rejecting more [default: 8]
+      --pipeline                Run sox and the analyzer as async subprocesses on a single event loop,
+                                with "--workers" analyzer processes, instead of a pool of worker processes
+      --sox-jobs=<jobs>         Number of concurrent sox processes with "--pipeline". Defaults to the number of CPUs.
+      --timeout=<seconds>       Kill sox and analyzer processes running longer than this with "--pipeline"
+      --outdir=<outdir>         Write full report for each file of a batch run, or all results, into this directory
+      --cache-dir=<cachedir>    Where to cache intermediate and final results. Defaults to ~/.cache/audiohealth.
+      --no-cache                Don't use the cache
+      --keep                    Keep (don't delete) the .dat file
+      --profile                 Report time, CPU, memory and I/O used by each stage and subprocess
+      --prometheus=<promfile>   Maintain profiling totals in this file, for the Prometheus node exporter
       --debug                   Enable debug messages
       -h --help                 Show this screen
 
@@ -484,29 +3516,189 @@ def main():
     options = docopt(main.__doc__, version=APP_NAME)
     #print('options:', options)
 
+    try:
+        run(options)
+    except AudiohealthError as ex:
+        print()
+        print('ERROR: {}'.format(ex))
+        sys.exit(ex.returncode)
+
+def run(options):
+
+    resampler = options.get('--resampler')
+    if resampler not in RESAMPLERS:
+        raise AudiohealthError('Unknown resampler "{}". Use one of {}.'.format(resampler, ', '.join(RESAMPLERS)))
+
+    transport = options.get('--transport')
+    if transport not in TRANSPORTS:
+        raise AudiohealthError('Unknown transport "{}". Use one of {}.'.format(transport, ', '.join(TRANSPORTS)))
+
+    format = options.get('--format')
+    if format not in FORMATS:
+        raise AudiohealthError('Unknown format "{}". Use one of {}.'.format(format, ', '.join(FORMATS)))
+    stdout = sys.stdout
+
+    cache = None
+    if not options.get('--no-cache'):
+        cache = ResultCache(options.get('--cache-dir') or CACHE_DIR)
+
+    bucket = options.get('--summary')
+    if bucket and bucket not in BUCKETS:
+        raise AudiohealthError('Unknown summary "{}". Use one of {}.'.format(bucket, ', '.join(BUCKETS)))
+    bucket = bucket and BUCKETS[bucket]
+
+    archive = None
+    hive = options.get('--hive')
+    if options.get('--archive') and not (options.get('query') or options.get('similar')):
+        if not hive:
+            raise AudiohealthError('Archiving needs the name of the hive, see "--hive"')
+        archive = Archive(options.get('--archive'))
+
+    profile = options.get('--profile')
+    if profile or options.get('--prometheus'):
+        hooks = []
+        if options.get('--prometheus'):
+            hooks.append(PrometheusExporter(options.get('--prometheus')))
+        PROFILER.enable(hooks)
+
+    if options.get('serve'):
+        serve(
+            host=options.get('--host'), port=int(options.get('--port')),
+            workers=options.get('--workers') and int(options.get('--workers')),
+            queue_size=int(options.get('--queue-size')),
+            analyzer=options.get('--analyzer') and os.path.abspath(options.get('--analyzer')),
+            resampler=resampler, transport=transport)
+        return
 
     if options.get('convert'):
         audiofile = options.get('--audiofile')
         wavfile   = options.get('--wavfile')
-        tmpfile   = resample(audiofile)
-        shutil.move(tmpfile, wavfile)
+        if resampler == 'native':
+            write_wav(wavfile, *prepare_samples(audiofile, resampler=resampler, cache=cache))
+        else:
+            tmpfile, temporary = prepare_wav(audiofile, cache=cache)
+            if temporary:
+                shutil.move(tmpfile, wavfile)
+            else:
+                shutil.copyfile(tmpfile, wavfile)
 
     if options.get('spectrogram'):
         audiofile = options.get('--audiofile')
         pngfile   = options.get('--pngfile')
-        tmpfile   = spectrogram(audiofile)
+        max_frames = options.get('--max-frames') and int(options.get('--max-frames'))
+        tmpfile   = spectrogram(audiofile, max_frames=max_frames)
         shutil.move(tmpfile, pngfile)
+        if profile:
+            print_profile(PROFILER.reset())
+
+    elif options.get('all'):
+        audiofile = options.get('--audiofile')
+        outdir    = options.get('--outdir')
+        limit     = options.get('--max-entries') and int(options.get('--max-entries'))
+        max_frames = options.get('--max-frames') and int(options.get('--max-frames'))
+        if len(parse_strategies(options.get('--strategy'))) > 1:
+            raise AudiohealthError('Multiple strategies are not supported by "all"')
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+
+        with quiet(format):
+            states, analysis, spectrogram_png, power_png = analyze_all(
+                audiofile, outdir, analyzer=options.get('--analyzer'), strategy=options.get('--strategy'),
+                transport=transport, max_frames=max_frames)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            report(states, limit=limit, bucket=bucket)
+            power_spectrum_report(analysis['peaks'])
+        with open(os.path.join(outdir, os.path.basename(audiofile) + '.txt'), 'w') as f:
+            f.write(output.getvalue())
+
+        if format == 'text':
+            sys.stdout.write(output.getvalue())
+            print('Wrote {} and {}'.format(spectrogram_png, power_png))
+            if profile:
+                print_profile(PROFILER.reset())
+        else:
+            record = {'audiofile': audiofile, 'strategy': options.get('--strategy') or DEFAULT_STRATEGY,
+                      'spectrogram': spectrogram_png, 'pngfile': power_png}
+            record.update(report_data(states, limit=limit, bucket=bucket))
+            record.update(power_data(analysis))
+            if profile:
+                record['profile'] = PROFILER.reset()
+            emit(record, format, stream=stdout)
 
     elif options.get('power'):
         audiofile = options.get('--audiofile')
         wavfile   = options.get('--wavfile')
         pngfile   = options.get('--pngfile')
-        if audiofile:
-            wavfile   = resample(audiofile)
-        tmpfile   = power_spectrum(wavfile)
-        if audiofile:
-            os.unlink(wavfile)
-        shutil.move(tmpfile, pngfile)
+        textual   = format == 'text'
+        window    = options.get('--window') and parse_duration(options.get('--window'))
+        hop       = options.get('--hop') and parse_duration(options.get('--hop')) or window
+        workers   = options.get('--workers') and int(options.get('--workers'))
+
+        if options.get('--fast') or window:
+            if pngfile:
+                raise AudiohealthError('Images are not supported with "--fast" and "--window", use "--no-png"')
+            if window and archive:
+                raise AudiohealthError('Archiving is not supported with "--window"')
+            with quiet(format):
+                if audiofile:
+                    samplerate, samples = prepare_samples(audiofile, resampler=resampler, cache=cache)
+                    samples = samples * (2.0 ** 15)
+                else:
+                    samplerate, samples = read_wav(wavfile)
+                    samples = pcm16_level(samples)
+                if options.get('--fast'):
+                    analysis = band_power(samples, samplerate, window=window, hop=hop)
+                else:
+                    analysis = windowed_power(samples, samplerate, window=window, hop=hop, workers=workers)
+            record = {'audiofile': audiofile, 'wavfile': options.get('--wavfile')}
+            if window:
+                record['windows'] = analysis
+            else:
+                record.update(analysis)
+                if archive:
+                    duration = len(samples) / float(samplerate)
+                    archive.append(
+                        hive, recording_time(audiofile or wavfile, duration, options.get('--start')),
+                        audiofile=audiofile or wavfile, analysis=dict(analysis, peaks={}), duration=duration)
+            if textual and window:
+                print_power_timeline(analysis)
+            elif textual:
+                print_verdict(analysis)
+            if textual and profile:
+                print_profile(PROFILER.reset())
+            if not textual:
+                if profile:
+                    record['profile'] = PROFILER.reset()
+                emit(record, format, stream=stdout)
+            return
+
+        with quiet(format):
+            if audiofile:
+                samplerate, samples = prepare_samples(audiofile, resampler=resampler, cache=cache)
+                tmpfile, analysis = power_spectrum(samplerate=samplerate, samples=samples * (2.0 ** 15), png=bool(pngfile), report=textual)
+            else:
+                tmpfile, analysis = power_spectrum(wavfile, png=bool(pngfile), report=textual)
+                samplerate, samples = read_wav(wavfile)
+                samples = pcm16_level(samples)
+        if pngfile:
+            shutil.move(tmpfile, pngfile)
+        if archive:
+            source = audiofile or wavfile
+            duration = len(samples) / float(samplerate)
+            embeddings = embed_recording(samples * (2.0 ** 15) if audiofile else samples, samplerate)
+            archive.append(
+                hive, recording_time(source, duration, options.get('--start')),
+                audiofile=source, analysis=analysis, duration=duration, embeddings=embeddings)
+        if textual and profile:
+            print_profile(PROFILER.reset())
+        if not textual:
+            record = {'audiofile': audiofile, 'wavfile': options.get('--wavfile'), 'pngfile': pngfile}
+            record.update(power_data(analysis))
+            if profile:
+                record['profile'] = PROFILER.reset()
+            emit(record, format, stream=stdout)
 
     elif options.get('analyze'):
 
@@ -516,26 +3708,196 @@ def main():
         analyzer  = options.get('--analyzer')
         strategy  = options.get('--strategy')
 
-        if audiofile:
-            wavfile = resample(audiofile)
-            datfile = wav_to_dat(wavfile)
-            if not options.get('--keep'):
-                os.unlink(wavfile)
-
-        elif wavfile:
-            datfile = wav_to_dat(wavfile)
-
+        strategies = parse_strategies(strategy)
+        limit = options.get('--max-entries') and int(options.get('--max-entries'))
+        if archive and len(strategies) > 1:
+            raise AudiohealthError('Multiple strategies are not supported when archiving')
+
+        if options.get('--resume'):
+            if len(strategies) > 1:
+                raise AudiohealthError('Multiple strategies are not supported when resuming')
+            with quiet(format):
+                states, chronology, new = resume_analysis(
+                    audiofile, checkpointfile=options.get('--checkpoint'), analyzer=analyzer, strategy=strategies[0],
+                    transport=transport)
+            if archive:
+                begin = recording_time(audiofile, len(states) * WINDOW_LENGTH, options.get('--start'))
+                archive.append(
+                    hive, begin + (len(states) - new) * WINDOW_LENGTH, audiofile=audiofile, states=states[len(states) - new:])
+            if format == 'text':
+                report(states, limit=limit, bucket=bucket)
+                print('Analyzed {} new windows.'.format(new))
+                if profile:
+                    print_profile(PROFILER.reset())
+            else:
+                record = {'audiofile': audiofile, 'strategy': strategies[0], 'new_windows': new}
+                record.update(report_data(states, limit=limit, bucket=bucket))
+                record['chronology'] = chronology[:limit]
+                if profile:
+                    record['profile'] = PROFILER.reset()
+                emit(record, format, stream=stdout)
+            return
+
+        with quiet(format):
+            results = run_strategies(
+                audiofile=audiofile, wavfile=wavfile, datfile=datfile, analyzer=analyzer, strategies=strategies,
+                resampler=resampler, transport=transport, keep=options.get('--keep'), cache=cache)
+
+        record = {'audiofile': audiofile, 'wavfile': wavfile, 'datfile': datfile}
+        if len(strategies) == 1:
+            states = results[strategies[0]]
+            record['strategy'] = strategies[0]
+            if archive:
+                source = audiofile or wavfile or datfile
+                archive.append(
+                    hive, recording_time(source, len(states) * WINDOW_LENGTH, options.get('--start')),
+                    audiofile=source, states=states)
+            record.update(report_data(states, limit=limit, bucket=bucket))
+            if format == 'text':
+                report(states, limit=limit, bucket=bucket)
+        else:
+            if format == 'text':
+                combined = report_strategies(results)
+            else:
+                combined = consensus(results)
+            record['strategies'] = {
+                strategy: report_data(states, limit=limit, bucket=bucket) for strategy, states in results.items()}
+            record['consensus'] = combined
+        if format == 'text' and profile:
+            print_profile(PROFILER.reset())
+        if format != 'text':
+            if profile:
+                record['profile'] = PROFILER.reset()
+            emit(record, format, stream=stdout)
+
+    elif options.get('stream'):
+
+        strategy = options.get('--strategy')
+        if len(parse_strategies(strategy)) > 1:
+            raise AudiohealthError('Multiple strategies are not supported in stream mode')
+
+        blocks = read_pcm(
+            sys.stdin.buffer, samplerate=int(options.get('--samplerate')), channels=int(options.get('--channels')))
+        samplerate = next(blocks)
+
+        entries = []
+        entries_stream = stream_analysis(
+            blocks, samplerate, analyzer=options.get('--analyzer'), strategy=strategy, transport=transport)
+        for entry in entries_stream:
+            if format == 'ndjson':
+                emit(entry, format)
+            elif format == 'json':
+                entries.append(entry['state'])
+            else:
+                print('{time_begin:6}s - {time_end:6}s   {state}'.format(**entry))
+                sys.stdout.flush()
+
+        if format == 'json':
+            record = report_data(entries)
+            if profile:
+                record['profile'] = PROFILER.reset()
+            emit(record, format)
+        elif profile and format == 'ndjson':
+            emit({'profile': PROFILER.reset()}, format)
+        elif profile:
+            print_profile(PROFILER.reset())
+
+    elif options.get('query'):
+
+        archive = Archive(options.get('--archive'))
+        result = archive.query(
+            hive=hive,
+            begin=options.get('--from') and parse_time(options.get('--from')),
+            end=options.get('--until') and parse_time(options.get('--until')),
+            bucket=bucket)
+        if format == 'text':
+            print_query(result)
         else:
-            datfile = options.get('--datfile')
+            emit(result, format)
 
-        states = analyze(datfile, analyzer=analyzer, strategy=strategy)
-        report(states)
+    elif options.get('similar'):
 
-        # Cleanup
-        if not options.get('--keep'):
-            # Only delete datfile if not directly specified on command line
-            if audiofile or wavfile:
-                os.unlink(datfile)
+        archive = Archive(options.get('--archive'))
+        recording = options.get('--recording') and int(options.get('--recording'))
+        if options.get('--audiofile'):
+            with quiet(format):
+                samplerate, samples = prepare_samples(options.get('--audiofile'), resampler=resampler, cache=cache)
+                offsets, vectors, vector = embed_recording(samples * (2.0 ** 15), samplerate)
+        else:
+            vector = archive.embedding(recording)
+        results = archive.similar(
+            vector, count=int(options.get('--count')), hive=hive, windows=options.get('--by-window'), exclude=recording)
+        audiofiles = archive.audiofiles(sorted(set(entry['recording'] for entry in results)))
+        for entry in results:
+            entry['audiofile'] = audiofiles.get(entry['recording']) or ''
+        if format == 'text':
+            print_similar(results)
+        else:
+            emit(results, format)
+
+    elif options.get('batch'):
+
+        audiofiles = expand_inputs(options.get('<input>'))
+        if len(parse_strategies(options.get('--strategy'))) > 1:
+            raise AudiohealthError('Multiple strategies are not supported in batch mode')
+        workers    = options.get('--workers') and int(options.get('--workers'))
+        outdir     = options.get('--outdir')
+        reports    = report_names(audiofiles)
+
+        failed = 0
+        records = []
+        if options.get('--pipeline'):
+            results = pipeline_batch(
+                audiofiles, analyzer=options.get('--analyzer'), strategy=options.get('--strategy'),
+                resampler=resampler, transport=transport, cache=cache,
+                sox_jobs=options.get('--sox-jobs') and int(options.get('--sox-jobs')), analyzer_jobs=workers,
+                timeout=options.get('--timeout') and float(options.get('--timeout')))
+        else:
+            results = batch(
+                audiofiles, workers=workers,
+                analyzer=options.get('--analyzer'), strategy=options.get('--strategy'),
+                resampler=resampler, transport=transport, cache=cache, profile=PROFILER.enabled)
+        for result in results:
+            for entry in result['profile'] or []:
+                PROFILER.add(entry)
+            if archive and not result['error']:
+                states = result['states']
+                archive.append(
+                    hive, recording_time(result['audiofile'], len(states) * WINDOW_LENGTH),
+                    audiofile=result['audiofile'], states=states)
+            if result['error']:
+                failed += 1
+            if outdir:
+                outfile = os.path.join(outdir, reports[result['audiofile']])
+                if not os.path.isdir(os.path.dirname(outfile)):
+                    os.makedirs(os.path.dirname(outfile))
+                with open(outfile, 'w') as f:
+                    f.write(result['output'])
+                    if result['error']:
+                        f.write('ERROR: {}\n'.format(result['error']))
+            record = batch_record(result)
+            if profile:
+                record['profile'] = result['profile']
+            if format == 'ndjson':
+                emit(record, format)
+            elif format == 'json':
+                records.append(record)
+            else:
+                print(batch_summary(result))
+                sys.stdout.flush()
+
+        if format == 'json':
+            emit(records, format)
+        if format == 'text':
+            print()
+            print('Processed {} files, {} failed.'.format(len(audiofiles), failed))
+            if profile:
+                print()
+                print_profile(PROFILER.reset())
+        else:
+            sys.stderr.write('Processed {} files, {} failed.\n'.format(len(audiofiles), failed))
+        if failed:
+            sys.exit(1)
 
 if __name__ == '__main__':
     main()
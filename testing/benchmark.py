@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the audiohealth processing pipeline.
+
+Usage:
+  benchmark.py transport [--duration 3600] [--analyzer /path/to/osbh-audioanalyzer]
+  benchmark.py startup [--repeat 10]
+  benchmark.py stages [--durations 60,3600] [--samplerate 44100] [--a250 0.3] [--a500 0.1] [--resampler native] [--max-frames 2000] [--output results.json]
+  benchmark.py windows [--duration 3600] [--workers 1]
+  benchmark.py all [--duration 3600] [--max-frames 2000]
+  benchmark.py render [--duration 3600] [--repeat 10]
+  benchmark.py pipeline [--duration 600] [--files 16] [--workers 4]
+  benchmark.py similar [--recordings 50000] [--repeat 10]
+  benchmark.py wav_to_dat [--duration 3600] [--dtype int16] [--transport binary]
+  benchmark.py compare <baseline> <results>
+  benchmark.py (-h | --help)
+
+Options:
+  --duration=<seconds>      Duration of synthetic input signal [default: 3600]
+  --durations=<seconds>     Comma-separated durations of synthetic recordings, e.g. 60,3600,86400 [default: 60,3600]
+  --samplerate=<rate>       Samplerate of synthetic recordings [default: 44100]
+  --a250=<amplitude>        Amplitude of the 250 Hz component [default: 0.3]
+  --a500=<amplitude>        Amplitude of the 500 Hz component [default: 0.1]
+  --resampler=<resampler>   How to downsample, sox or native [default: native]
+  --max-frames=<frames>     Time bins of the spectrogram [default: 2000]
+  --output=<file>           Write results to this JSON file
+  --repeat=<count>          How often to repeat measurements [default: 10]
+  --analyzer=<analyzer>     Analyzer reading float32 samples from stdin. Defaults to testing/fake_analyzer.py.
+  --workers=<workers>       Number of threads for FFTs, or of processes for pipeline [default: 1]
+  --files=<count>           Number of synthetic recordings [default: 16]
+  --recordings=<count>      Number of archived recordings [default: 50000]
+  --dtype=<dtype>           Sample format of the .wav file, int16, int32 or float32 [default: int16]
+  --transport=<transport>   Format of the .dat file, text or binary [default: binary]
+  -h --help                 Show this screen
+
+The "stages" benchmark runs each stage of the pipeline separately on
+synthetic recordings, using testing/fake_analyzer.py instead of
+osbh-audioanalyzer. It records wall and CPU time, the peak of memory
+allocated by Python and NumPy and the peak RSS of subprocesses. Use
+"compare" to check results of two versions against each other.
+
+The "all" benchmark compares "audiohealth all" against the three separate
+invocations of "analyze", "power" and "spectrogram" it replaces.
+
+The "render" benchmark renders the full-resolution spectrogram and the
+power spectrum of a synthetic recording repeatedly, reporting the time
+per image and the memory still held by Python after each round.
+
+The "pipeline" benchmark processes synthetic recordings with "audiohealth
+batch", once on a pool of worker processes and once with "--pipeline",
+using sox and testing/fake_analyzer.py.
+
+The "similar" benchmark fills an archive with embeddings of synthetic
+recordings, one per hour, and measures searches for similar recordings.
+
+The "wav_to_dat" benchmark converts a downsampled .wav file, once by
+reading it whole and scaling it in float64, like audiohealth 0.5.0 did,
+and once with "wav_to_dat()". Each runs in a subprocess of its own, to
+report its peak RSS, next to the RSS of just importing audiohealth.
+
+"""
+import os
+import io
+import gc
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tracemalloc
+import tempfile
+import subprocess
+import numpy as np
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from contextlib import redirect_stdout
+import audiohealth
+from audiohealth import SAMPLERATE, DAT_SUFFIX, write_wav
+
+AUDIOHEALTH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'audiohealth.py')
+FAKE_ANALYZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_analyzer.py')
+
+
+def synthetic_samples(duration, samplerate=SAMPLERATE, seed=42, a250=0.3, a500=0.1, noise=0.05, start=0):
+    """
+    Bee-like signal: Strong component at 250 Hz, weaker one at 500 Hz, plus noise.
+    """
+    rng = np.random.default_rng([seed, start])
+    t = (start + np.arange(int(duration * samplerate))) / float(samplerate)
+    x = a250 * np.sin(2 * np.pi * 250 * t) + a500 * np.sin(2 * np.pi * 500 * t)
+    x += noise * rng.standard_normal(t.shape)
+    return x.astype(np.float32)
+
+
+def synthetic_wav(wavfile, duration, samplerate=44100, chunk=60, **kwargs):
+    """
+    Write a synthetic recording as 16-bit .wav file, minute by minute,
+    so even recordings of a whole day don't need to fit into memory.
+    """
+    frames = int(duration * samplerate)
+    with open(wavfile, 'wb') as f:
+        f.write(b'RIFF' + (36 + 2 * frames).to_bytes(4, 'little') + b'WAVE')
+        f.write(b'fmt ' + (16).to_bytes(4, 'little'))
+        f.write(np.array([1, 1], dtype='<u2').tobytes() + np.array([samplerate, 2 * samplerate], dtype='<u4').tobytes())
+        f.write(np.array([2, 16], dtype='<u2').tobytes())
+        f.write(b'data' + (2 * frames).to_bytes(4, 'little'))
+        for start in range(0, frames, chunk * samplerate):
+            size = min(chunk * samplerate, frames - start)
+            x = synthetic_samples(size / float(samplerate), samplerate=samplerate, start=start, **kwargs)
+            np.clip(np.round(x * 2 ** 15), -2 ** 15, 2 ** 15 - 1).astype('<i2').tofile(f)
+    return wavfile
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def profiled(func, *args, **kwargs):
+    """
+    Run a function, measuring wall and CPU time, the peak of memory
+    allocated through Python (which includes NumPy arrays) and the
+    peak RSS of any subprocess.
+    """
+    tracemalloc.start()
+    cpu = time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall, result = timed(func, *args, **kwargs)
+    cpu = time.process_time() - cpu
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'wall': wall,
+        'cpu': cpu + (after.ru_utime - children.ru_utime) + (after.ru_stime - children.ru_stime),
+        'peak_memory': peak,
+        # Linux reports the maximum RSS of all children so far, in KiB.
+        'peak_subprocess_rss': after.ru_maxrss * 1024 if after.ru_maxrss > children.ru_maxrss else None,
+    }, result
+
+
+def benchmark_stages(durations, samplerate=44100, resampler='native', max_frames=2000, **signal):
+    """
+    Time and memory-profile each stage of the pipeline on synthetic recordings.
+    """
+    results = {
+        'version': audiohealth.VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': dict(signal, samplerate=samplerate, resampler=resampler, max_frames=max_frames),
+        'durations': {},
+    }
+    for duration in durations:
+        workdir = tempfile.mkdtemp()
+        try:
+            audiofile = synthetic_wav(os.path.join(workdir, 'hive.wav'), duration, samplerate=samplerate, **signal)
+            wavfile = os.path.join(workdir, 'hive-6300.wav')
+            stages = {}
+
+            def resample():
+                if resampler == 'sox':
+                    shutil.move(audiohealth.resample(audiofile), wavfile)
+                else:
+                    write_wav(wavfile, *audiohealth.resample_native(audiofile))
+
+            with redirect_stdout(io.StringIO()):
+                stages['resample'], _ = profiled(resample)
+                stages['wav_to_dat'], datfile = profiled(audiohealth.wav_to_dat, wavfile)
+                stages['analyze'], states = profiled(audiohealth.analyze, datfile, analyzer=FAKE_ANALYZER)
+                stages['report'], _ = profiled(audiohealth.report, states)
+                stages['spectrogram'], pngfile = profiled(audiohealth.spectrogram, wavfile, max_frames=max_frames)
+                stages['power_spectrum'], (powerfile, _) = profiled(audiohealth.power_spectrum, wavfile)
+            for filename in [pngfile, powerfile]:
+                os.unlink(filename)
+
+            results['durations'][str(duration)] = stages
+            print('Duration {}s'.format(duration))
+            for stage, result in stages.items():
+                print('  {stage:16} wall: {wall:8.3f}s   cpu: {cpu:8.3f}s   memory: {memory:8.1f} MiB'.format(
+                    stage=stage, memory=result['peak_memory'] / 2.0 ** 20, **result))
+        finally:
+            shutil.rmtree(workdir)
+    return results
+
+
+def benchmark_windows(duration, workers=1):
+    """
+    Compare the time-resolved power analysis against running
+    "power_spectrum()" on each window of 60 seconds, every 30 seconds.
+    """
+    samples = np.concatenate([
+        synthetic_samples(min(3600, duration - start), start=int(start * SAMPLERATE)) * 2 ** 15
+        for start in range(0, int(duration), 3600)])
+
+    windowed_time, windows = timed(audiohealth.windowed_power, samples, SAMPLERATE, 60, 30, workers=workers)
+    band_time, _ = timed(audiohealth.band_power, samples, SAMPLERATE, 60, 30)
+
+    def separately():
+        with redirect_stdout(io.StringIO()):
+            for entry in windows:
+                begin, end = int(round(entry['time_begin'] * SAMPLERATE)), int(round(entry['time_end'] * SAMPLERATE))
+                audiohealth.power_spectrum(samplerate=SAMPLERATE, samples=samples[begin:end], png=False, report=False)
+    separate_time, _ = timed(separately)
+
+    print('Windowed power analysis of {}s of audio, {} windows'.format(duration, len(windows)))
+    print('{:28} {:8.3f}s'.format('power_spectrum per window', separate_time))
+    print('{:28} {:8.3f}s'.format('windowed_power', windowed_time))
+    print('{:28} {:8.3f}s'.format('band_power', band_time))
+    return {'separate': separate_time, 'windowed': windowed_time, 'band': band_time}
+
+
+def benchmark_all(duration, max_frames=2000):
+    """
+    Compare producing states, power spectrum and both images with a single
+    "audiohealth all" against separate "analyze", "power" and "spectrogram" runs.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        audiofile = synthetic_wav(os.path.join(workdir, 'hive.wav'), duration)
+        common = ['--audiofile', audiofile]
+        analyzer = ['--analyzer', FAKE_ANALYZER]
+        separate = [
+            ['analyze'] + common + analyzer + ['--resampler', 'native', '--no-cache'],
+            ['power'] + common + ['--pngfile', os.path.join(workdir, 'power.png'), '--resampler', 'native', '--no-cache'],
+            ['spectrogram'] + common + ['--pngfile', os.path.join(workdir, 'spectrogram.png'), '--max-frames', str(max_frames)],
+        ]
+        combined = ['all'] + common + analyzer + ['--outdir', os.path.join(workdir, 'all'), '--max-frames', str(max_frames)]
+
+        def run(arguments):
+            subprocess.check_call([sys.executable, AUDIOHEALTH] + arguments, stdout=subprocess.DEVNULL)
+
+        results = {}
+        for arguments in separate:
+            results[arguments[0]], _ = timed(run, arguments)
+        results['all'], _ = timed(run, combined)
+    finally:
+        shutil.rmtree(workdir)
+
+    total = sum(results[name] for name in ['analyze', 'power', 'spectrogram'])
+    print('Single-decode run of {}s of audio'.format(duration))
+    for name, seconds in results.items():
+        print('{name:20} {seconds:8.3f}s'.format(name=name, seconds=seconds))
+    print('{:20} {:8.3f}s'.format('separate total', total))
+    print('Speedup: {:.1f}x'.format(total / results['all']))
+    return results
+
+
+def benchmark_render(duration, repeat=10):
+    """
+    Measure rendering of spectrogram and power spectrum images and whether
+    memory keeps growing when rendering repeatedly within one process.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        audiofile = synthetic_wav(os.path.join(workdir, 'hive.wav'), duration)
+        specgram, time_step, samplerate = audiohealth.compute_spectrogram(audiofile)
+        samples = synthetic_samples(min(duration, 600)) * 2 ** 15
+        f, Pxx_spec = audiohealth.compute_power_spectrum(samplerate=SAMPLERATE, samples=samples)
+        peak_freq, peak_power = audiohealth.find_peaks(f, Pxx_spec)
+
+        results = {'spectrogram': [], 'power_spectrum': [], 'retained_memory': []}
+        tracemalloc.start()
+        for i in range(repeat):
+            seconds, pngfile = timed(audiohealth.render_spectrogram, specgram, time_step, samplerate)
+            os.unlink(pngfile)
+            results['spectrogram'].append(seconds)
+            seconds, pngfile = timed(audiohealth.render_power_spectrum, f, Pxx_spec, peak_freq, peak_power)
+            os.unlink(pngfile)
+            results['power_spectrum'].append(seconds)
+            gc.collect()
+            results['retained_memory'].append(tracemalloc.get_traced_memory()[0])
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(workdir)
+
+    print('Rendering images of {}s of audio, {} spectrogram frames, {} rounds'.format(duration, len(specgram), repeat))
+    for name in ['spectrogram', 'power_spectrum']:
+        print('{:20} median: {:8.3f}s   first: {:8.3f}s'.format(name, np.median(results[name]), results[name][0]))
+    retained = results['retained_memory']
+    print('{:20} after first round: {:8.1f} MiB   after last round: {:8.1f} MiB'.format(
+        'retained memory', retained[0] / 2.0 ** 20, retained[-1] / 2.0 ** 20))
+    return results
+
+
+def benchmark_pipeline(duration, files=16, workers=4):
+    """
+    Compare "audiohealth batch" on a pool of worker processes
+    against "audiohealth batch --pipeline", downsampling with sox.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        audiofile = synthetic_wav(os.path.join(workdir, 'hive-0.wav'), duration)
+        for index in range(1, files):
+            shutil.copy(audiofile, os.path.join(workdir, 'hive-{}.wav'.format(index)))
+        common = [
+            'batch', workdir, '--analyzer', FAKE_ANALYZER, '--resampler', 'sox',
+            '--workers', str(workers), '--no-cache', '--format', 'ndjson']
+
+        def run(arguments):
+            output = subprocess.check_output([sys.executable, AUDIOHEALTH] + arguments)
+            return [json.loads(line) for line in output.splitlines()]
+
+        results = {}
+        results['pool'], pool = timed(run, common)
+        results['pipeline'], pipeline = timed(run, common + ['--pipeline', '--sox-jobs', str(workers)])
+    finally:
+        shutil.rmtree(workdir)
+
+    states = lambda records: sorted((record['audiofile'], record['status'], record['states']) for record in records)
+    print('Batch run of {} files of {}s each, {} workers'.format(files, duration, workers))
+    for name, seconds in results.items():
+        print('{name:20} {seconds:8.3f}s'.format(name=name, seconds=seconds))
+    print('Speedup: {:.1f}x'.format(results['pool'] / results['pipeline']))
+    print('Identical states: {}'.format(states(pool) == states(pipeline)))
+    return results
+
+
+def benchmark_similar(recordings, repeat=10):
+    """
+    Time "Archive.similar()" on an archive of many recordings, whose
+    embeddings are derived from spectra of a few synthetic signals.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        archive = audiohealth.Archive(workdir)
+        templates = []
+        for a500 in [0.02, 0.1, 0.3]:
+            samples = synthetic_samples(600, a500=a500) * (2.0 ** 15)
+            templates.append(audiohealth.embed_recording(samples, SAMPLERATE))
+
+        rng = np.random.default_rng(42)
+        append_time = 0
+        for index in range(recordings):
+            offsets, vectors, vector = templates[index % len(templates)]
+            noisy = (vectors + rng.normal(0, 0.01, vectors.shape)).astype(np.float32)
+            seconds, _ = timed(
+                archive.append, 'hive-{}'.format(index % 10), index * 3600.0,
+                duration=600, embeddings=(offsets, noisy, noisy.mean(axis=0)))
+            append_time += seconds
+
+        times = {}
+        for windows in [False, True]:
+            archive = audiohealth.Archive(workdir)
+            times[windows] = min(timed(archive.similar, templates[2][2], windows=windows)[0] for i in range(repeat))
+        matches = archive.similar(templates[2][2], count=10)
+    finally:
+        shutil.rmtree(workdir)
+
+    print('Archive of {} recordings'.format(recordings))
+    print('{:20} {:8.3f}ms'.format('append', 1000 * append_time / recordings))
+    print('{:20} {:8.3f}ms'.format('similar recordings', 1000 * times[False]))
+    print('{:20} {:8.3f}ms'.format('similar windows', 1000 * times[True]))
+    print('Best matches of the same template: {}'.format(all(match['recording'] % 3 == 2 for match in matches)))
+    return times
+
+
+WAV_TO_DAT_RUNS = {
+    'import': 'import audiohealth',
+    'whole': 'fs, snd = wav.read(sys.argv[1]); audiohealth.samples_to_dat(snd / (2.0 ** 15), sys.argv[2], transport=sys.argv[3])',
+    'chunked': 'audiohealth.wav_to_dat(sys.argv[1], transport=sys.argv[3], outfile=sys.argv[2])',
+}
+
+
+def benchmark_wav_to_dat(duration, dtype='int16', transport='binary'):
+    """
+    Compare peak RSS and time of converting a downsampled .wav file
+    in one go against converting it block by block.
+    """
+    workdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        wavfile = os.path.join(workdir, 'hive.wav')
+        if dtype == 'int16':
+            synthetic_wav(wavfile, duration, samplerate=SAMPLERATE)
+        else:
+            samples = synthetic_samples(duration)
+            if dtype == 'int32':
+                samples = np.round(samples * (2 ** 31 - 1)).astype(np.int32)
+            audiohealth.wav.write(wavfile, SAMPLERATE, samples.astype(dtype))
+            del samples
+
+        outputs = {}
+        for name, code in WAV_TO_DAT_RUNS.items():
+            outfile = os.path.join(workdir, name + DAT_SUFFIX[transport])
+            script = 'import sys; sys.path.insert(0, {!r}); import scipy.io.wavfile as wav; {}'.format(
+                os.path.dirname(AUDIOHEALTH), code if name == 'import' else 'import audiohealth; ' + code)
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, '-c', script, wavfile, outfile, transport], stdout=subprocess.DEVNULL)
+            _, status, usage = os.wait4(process.pid, 0)
+            if os.waitstatus_to_exitcode(status) != 0:
+                raise RuntimeError('Converting with "{}" failed'.format(name))
+            results[name] = {'wall': time.perf_counter() - start, 'peak_rss': usage.ru_maxrss * 1024}
+            if os.path.exists(outfile):
+                if transport == 'binary':
+                    outputs[name] = np.fromfile(outfile, dtype='<f4')
+                else:
+                    outputs[name] = np.fromfile(outfile, dtype=np.float32, sep='\n')
+                os.unlink(outfile)
+    finally:
+        shutil.rmtree(workdir)
+
+    print('Converting {}s of {} audio at {} Hz to {} .dat file'.format(duration, dtype, SAMPLERATE, transport))
+    for name, result in results.items():
+        print('{name:10} {wall:8.3f}s   peak RSS {rss:10.1f} MiB'.format(name=name, rss=result['peak_rss'] / 2.0 ** 20, **result))
+    base = results['import']['peak_rss']
+    print('RSS beyond import: {:.1f}x less'.format(
+        (results['whole']['peak_rss'] - base) / float(max(results['chunked']['peak_rss'] - base, 1))))
+    print('Peak of converted samples: {:.3f}'.format(float(np.abs(outputs['chunked']).max())))
+    if dtype == 'int16':
+        print('Identical output: {}'.format(np.array_equal(outputs['whole'], outputs['chunked'])))
+    return results
+
+
+def compare_results(baseline, results):
+    """
+    Print the ratio of wall time and peak memory of each stage, relative to a baseline.
+    """
+    print('Comparing {} ({}) against baseline {} ({})'.format(
+        results['version'], results['timestamp'], baseline['version'], baseline['timestamp']))
+    for duration, stages in results['durations'].items():
+        if duration not in baseline['durations']:
+            continue
+        print('Duration {}s'.format(duration))
+        for stage, result in stages.items():
+            before = baseline['durations'][duration].get(stage)
+            if not before:
+                continue
+            print('  {stage:16} wall: {wall:6.2f}x   memory: {memory:6.2f}x'.format(
+                stage=stage, wall=result['wall'] / max(before['wall'], 1e-9),
+                memory=result['peak_memory'] / float(max(before['peak_memory'], 1))))
+
+
+def benchmark_transport(duration, analyzer=None):
+    """
+    Compare handing over samples to the analyzer as text .dat file against
+    piping raw float32 to its stdin, end to end through "analyze_samples()",
+    including the analyzer run. Without a build supporting the "binary"
+    transport, testing/fake_analyzer.py stands in for osbh-audioanalyzer.
+    """
+    analyzer = analyzer or FAKE_ANALYZER
+    if audiohealth.analyzer_transport(analyzer, 'binary') != 'binary':
+        raise SystemExit('{} does not support the "binary" transport'.format(analyzer))
+    samples = synthetic_samples(duration)
+    results = {}
+    for transport in ['text', 'binary']:
+        seconds, states = timed(audiohealth.analyze_samples, samples, analyzer=analyzer, transport=transport)
+        results[transport] = {'wall': seconds, 'states': states}
+
+    print('Transport benchmark for {}s of audio at {} Hz, using {}'.format(duration, SAMPLERATE, analyzer))
+    for transport, result in results.items():
+        print('{transport:10} {wall:8.3f}s'.format(transport=transport, **result))
+    print('Speedup: {:.1f}x'.format(results['text']['wall'] / results['binary']['wall']))
+    print('Identical states: {}'.format(results['text']['states'] == results['binary']['states']))
+    return results
+
+
+def benchmark_startup(repeat):
+    """
+    Measure the cold start of "audiohealth power" on a short file,
+    with and without rendering the image, in fresh interpreters.
+    """
+    workdir = tempfile.mkdtemp()
+    wavfile = os.path.join(workdir, 'short.wav')
+    pngfile = os.path.join(workdir, 'short.png')
+    write_wav(wavfile, SAMPLERATE, synthetic_samples(1))
+
+    commands = {
+        'import': [sys.executable, '-c', 'import sys; sys.path.insert(0, {!r}); import audiohealth'.format(os.path.dirname(AUDIOHEALTH))],
+        'power --no-png': [sys.executable, AUDIOHEALTH, 'power', '--wavfile', wavfile, '--no-png'],
+        'power --pngfile': [sys.executable, AUDIOHEALTH, 'power', '--wavfile', wavfile, '--pngfile', pngfile],
+    }
+    results = {}
+    try:
+        for name, command in commands.items():
+            durations = []
+            for i in range(repeat):
+                duration, _ = timed(subprocess.check_call, command, stdout=subprocess.DEVNULL)
+                durations.append(duration)
+            results[name] = float(np.median(durations))
+    finally:
+        shutil.rmtree(workdir)
+
+    print('Startup benchmark, median of {} runs'.format(repeat))
+    for name, duration in results.items():
+        print('{name:20} {duration:8.3f}s'.format(name=name, duration=duration))
+    return results
+
+
+def main():
+    options = docopt(__doc__)
+    duration = float(options['--duration'])
+    if options['transport']:
+        benchmark_transport(duration, analyzer=options['--analyzer'])
+    elif options['startup']:
+        benchmark_startup(int(options['--repeat']))
+    elif options['stages']:
+        results = benchmark_stages(
+            [int(value) for value in options['--durations'].split(',')],
+            samplerate=int(options['--samplerate']), resampler=options['--resampler'],
+            max_frames=int(options['--max-frames']),
+            a250=float(options['--a250']), a500=float(options['--a500']))
+        if options['--output']:
+            with open(options['--output'], 'w') as f:
+                json.dump(results, f, indent=2)
+    elif options['windows']:
+        benchmark_windows(duration, workers=int(options['--workers']))
+    elif options['all']:
+        benchmark_all(duration, max_frames=int(options['--max-frames']))
+    elif options['render']:
+        benchmark_render(duration, repeat=int(options['--repeat']))
+    elif options['wav_to_dat']:
+        benchmark_wav_to_dat(duration, dtype=options['--dtype'], transport=options['--transport'])
+    elif options['similar']:
+        benchmark_similar(int(options['--recordings']), repeat=int(options['--repeat']))
+    elif options['pipeline']:
+        benchmark_pipeline(duration, files=int(options['--files']), workers=int(options['--workers']))
+    elif options['compare']:
+        with open(options['<baseline>']) as f:
+            baseline = json.load(f)
+        with open(options['<results>']) as f:
+            results = json.load(f)
+        compare_results(baseline, results)
+
+
+if __name__ == '__main__':
+    main()
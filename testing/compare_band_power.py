@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Validate the band-energy fast path and the windowed power spectrum analysis
+against the full power spectrum analysis.
+
+Synopsis::
+
+    python testing/compare_band_power.py hive-6300.wav [window]
+
+Compares the activity and queen verdicts and the band powers of
+"band_power()" against "power_spectrum()" for the whole recording
+and, when a window duration in seconds is given, those of
+"band_power()" and "windowed_power()" for each sliding window.
+Exits non-zero on any disagreement.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from audiohealth import band_power, power_spectrum, read_wav, windowed_power
+
+
+def same(reference, fast):
+    if (reference['activity'], reference['queenless']) != (fast['activity'], fast['queenless']):
+        return False
+    for name in ['band250', 'band500']:
+        if (reference[name] is None) != (fast[name] is None):
+            return False
+        if reference[name] and abs(reference[name]['power'] - fast[name]['power']) > 1e-6 * reference[name]['power']:
+            return False
+    return True
+
+
+def compare(wavfile, window=None):
+    samplerate, samples = read_wav(wavfile)
+    if samples.ndim == 2:
+        samples = samples[:, 0]
+
+    start = time.perf_counter()
+    _, reference = power_spectrum(samplerate=samplerate, samples=samples, png=False, report=False)
+    middle = time.perf_counter()
+    fast = band_power(samples, samplerate)
+    end = time.perf_counter()
+    success = same(reference, fast)
+    print('whole file:  full {:.3f}s, fast {:.3f}s, {}'.format(middle - start, end - middle, 'OK' if success else 'FAILED'))
+
+    functions = [('band_power', band_power), ('windowed_power', windowed_power)] if window else []
+    for name, function in functions:
+        start = time.perf_counter()
+        windows = function(samples, samplerate, window, window / 2)
+        duration = time.perf_counter() - start
+        failures = 0
+        for entry in windows:
+            begin, end = int(round(entry['time_begin'] * samplerate)), int(round(entry['time_end'] * samplerate))
+            _, reference = power_spectrum(samplerate=samplerate, samples=samples[begin:end], png=False, report=False)
+            if not same(reference, entry):
+                failures += 1
+                print('    window {:.1f}s - {:.1f}s differs'.format(entry['time_begin'], entry['time_end']))
+        print('{}: {:.3f}s, {} of {} windows differ'.format(name, duration, failures, len(windows)))
+        success = success and not failures
+
+    return success
+
+
+if __name__ == '__main__':
+    wavfile = sys.argv[1]
+    window = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    if not compare(wavfile, window):
+        print('FAILED: Fast path disagrees with full analysis')
+        sys.exit(1)
+    print('OK')
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Compare the in-process resampler against the sox chain.
+
+Synopsis::
+
+    python testing/compare_resample.py colony-with-queen-gruber.mp3
+
+Both outputs are scaled to -1..1 and compared sample by sample. The
+program exits non-zero when the signal-to-error ratio drops below
+the threshold (default: 30 dB).
+"""
+import os
+import sys
+import numpy as np
+import scipy.io.wavfile as wav
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from audiohealth import resample, resample_native
+
+
+def compare(audiofile, threshold=30.0):
+    wavfile = resample(audiofile)
+    try:
+        samplerate_sox, reference = wav.read(wavfile)
+    finally:
+        os.unlink(wavfile)
+    reference = reference / (2.0 ** 15)
+
+    samplerate_native, samples = resample_native(audiofile)
+    assert samplerate_sox == samplerate_native, 'Samplerates differ'
+
+    # sox and scipy might disagree about the very last output sample.
+    size = min(len(reference), len(samples))
+    reference, samples = reference[:size], samples[:size]
+
+    error = samples - reference
+    snr = 10 * np.log10(np.sum(reference ** 2) / max(np.sum(error ** 2), 1e-20))
+    print('samples:   {} / {}'.format(len(reference), len(samples)))
+    print('max error: {:.6f}'.format(np.abs(error).max()))
+    print('SNR:       {:.2f} dB'.format(snr))
+
+    return snr >= threshold
+
+
+if __name__ == '__main__':
+    audiofile = sys.argv[1]
+    threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 30.0
+    if not compare(audiofile, threshold):
+        print('FAILED: Resamplers are not numerically equivalent')
+        sys.exit(1)
+    print('OK')
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+Stand-in for osbh-audioanalyzer, for running benchmarks without the C++ build.
+
+Synopsis::
+
+    python testing/fake_analyzer.py samples.dat lr-2.1
+    python testing/fake_analyzer.py - lr-2.1 < samples.f32
+
+Reads samples at 6300 Hz like the real analyzer, either as text file or
+as raw float32 from stdin, and prints one state per 10 seconds. The state
+is derived from the energy ratio of the 500 Hz and 250 Hz bands, which is
+enough to produce plausible sequences and to cost a similar amount of I/O.
+"""
+import sys
+import numpy as np
+
+SAMPLERATE = 6300
+WINDOW_LENGTH = 10
+
+
+def read_samples(filename):
+    if filename == '-':
+        return np.frombuffer(sys.stdin.buffer.read(), dtype='<f4')
+    return np.fromfile(filename, dtype=np.float64, sep='\n')
+
+
+def classify(samples):
+    size = WINDOW_LENGTH * SAMPLERATE
+    count = len(samples) // size
+    frames = samples[:count * size].reshape(count, size)
+    spectrum = np.abs(np.fft.rfft(frames, axis=1))
+    freqs = np.fft.rfftfreq(size, 1.0 / SAMPLERATE)
+    band250 = spectrum[:, (freqs >= 220) & (freqs <= 275)].max(axis=1, initial=0)
+    band500 = spectrum[:, (freqs >= 445) & (freqs <= 525)].max(axis=1, initial=0)
+    ratio = band500 / np.maximum(band250, 1e-12)
+    states = np.where(band250 < 1e-3, 'queenless', np.where(ratio > 0.6, 'pre-swarm', 'active'))
+    return list(states)
+
+
+if __name__ == '__main__':
+    for state in classify(read_samples(sys.argv[1])):
+        print(state)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Exercise "audiohealth serve" offline against localhost.
+
+Synopsis::
+
+    python testing/serve_check.py [duration]
+
+Starts the server on a free port with testing/fake_analyzer.py and the
+native resampler, uploads a synthetic recording of the given duration
+in seconds (default 60) to each endpoint and checks the responses.
+Then floods a server with a single worker and a queue of one with
+concurrent uploads, which has to reject some of them with 503.
+Exits non-zero on any failure.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+from benchmark import AUDIOHEALTH, FAKE_ANALYZER, synthetic_wav
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def request(port, method, path, body=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        return response.status, response.getheader('Content-Type'), response.read()
+    finally:
+        connection.close()
+
+
+def start_server(*arguments):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, AUDIOHEALTH, 'serve', '--port', str(port), '--analyzer', FAKE_ANALYZER,
+         '--resampler', 'native'] + list(arguments))
+    for i in range(600):
+        try:
+            if request(port, 'GET', '/health')[0] == 200:
+                return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Server did not come up')
+
+
+def check(name, condition):
+    print('{:50} {}'.format(name, 'OK' if condition else 'FAILED'))
+    return condition
+
+
+def check_endpoints(upload):
+    process, port = start_server('--workers', '2')
+    success = True
+    try:
+        status, content_type, body = request(port, 'POST', '/analyze?filename=hive.wav', upload)
+        record = json.loads(body)
+        success &= check('analyze', status == 200 and len(record['states']) == len(upload) // (2 * 44100 * 10))
+
+        status, content_type, body = request(port, 'POST', '/power?filename=hive.wav&png=1', upload)
+        record = json.loads(body)
+        success &= check('power with image', status == 200 and record['activity'] == 'high' and 'png' in record)
+
+        status, content_type, body = request(port, 'POST', '/power?filename=hive.wav&fast=1', upload)
+        success &= check('power --fast', status == 200 and json.loads(body)['band250'] is not None)
+
+        status, content_type, body = request(port, 'POST', '/spectrogram?filename=hive.wav&max_frames=500', upload)
+        success &= check('spectrogram', status == 200 and content_type == 'image/png' and body.startswith(b'\x89PNG'))
+
+        status, content_type, body = request(port, 'POST', '/all?filename=hive.wav&png=1', upload)
+        record = json.loads(body)
+        success &= check('all', status == 200 and 'spectrogram_png' in record and bool(record['states']))
+
+        status, content_type, body = request(port, 'POST', '/analyze?filename=hive.wav', b'no audio')
+        success &= check('invalid upload', status == 422 and 'error' in json.loads(body))
+
+        success &= check('unknown command', request(port, 'POST', '/unknown', upload)[0] == 404)
+        success &= check('analyze via GET', request(port, 'GET', '/analyze')[0] == 405)
+    finally:
+        process.terminate()
+        process.wait()
+    return success
+
+
+def check_backpressure(upload, concurrency=6):
+    process, port = start_server('--workers', '1', '--queue-size', '1')
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(request, port, 'POST', '/power?filename=hive.wav', upload)
+                       for i in range(concurrency)]
+            statuses = sorted(future.result()[0] for future in futures)
+    finally:
+        process.terminate()
+        process.wait()
+    print('    statuses: {}'.format(statuses))
+    return check('back-pressure', 200 in statuses and 503 in statuses and set(statuses) <= {200, 503})
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    workdir = tempfile.mkdtemp()
+    wavfile = synthetic_wav(os.path.join(workdir, 'hive.wav'), duration)
+    with open(wavfile, 'rb') as f:
+        upload = f.read()
+    os.unlink(wavfile)
+    os.rmdir(workdir)
+
+    results = [check_endpoints(upload), check_backpressure(upload)]
+    if not all(results):
+        print('FAILED')
+        sys.exit(1)
+    print('OK')
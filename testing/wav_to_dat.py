@@ -27,22 +27,22 @@ import scipy.io.wavfile as wav
 
 def convert(filename):
     sampFreq, snd = wav.read(filename)
-    #print 'snd:', snd
+    #print('snd:', snd)
 
-    print 'sampFreq:', sampFreq
+    print('sampFreq:', sampFreq)
     #print dir(snd)
     #print snd.nbytes
 
-    print 'dtype:', snd.dtype
-    print 'shape:', snd.shape
-    print 'size:', snd.size
+    print('dtype:', snd.dtype)
+    print('shape:', snd.shape)
+    print('size:', snd.size)
     duration = snd.shape[0] / sampFreq
-    print 'duration:', duration
+    print('duration:', duration)
 
     if snd.ndim == 1:
-        print 'mono'
+        print('mono')
     else:
-        print 'stereo: will select channel 1'
+        print('stereo: will select channel 1')
         snd = snd.T[0]
 
     #print snd
@@ -66,12 +66,12 @@ def convert(filename):
 
         interval = chunksize * sampFreq
 
-        print len(snd)
+        print(len(snd))
         steps = range(0, snd.size, interval)
-        print 'steps:', steps
+        print('steps:', steps)
         for step in steps:
             part = snd[step:step+interval]
-            print 'len:' + str(len(part))
+            print('len:' + str(len(part)))
     """
 
     #print snd